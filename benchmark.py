@@ -0,0 +1,703 @@
+import os
+import sys
+import re
+import json
+import time
+import types
+import random
+import hashlib
+import itertools
+import argparse
+import builtins
+import functools
+import tempfile
+import threading
+
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, unquote
+
+PROFILES = {
+    'fast': {
+        'lastfm': (0.02, 0.01),
+        'web': (0.05, 0.02),
+        'mirror': (0.05, 0.02),
+        'extract': (0.1, 0.05),
+        'failure': 0.0,
+        'unavailable': 0.0,
+    },
+    'typical': {
+        'lastfm': (0.15, 0.05),
+        'web': (0.4, 0.1),
+        'mirror': (0.6, 0.3),
+        'extract': (1.5, 0.5),
+        'failure': 0.02,
+        'unavailable': 0.2,
+    },
+    'degraded': {
+        'lastfm': (0.5, 0.3),
+        'web': (1.0, 0.5),
+        'mirror': (1.5, 1.0),
+        'extract': (3.0, 1.0),
+        'failure': 0.1,
+        'unavailable': 0.4,
+    },
+}
+
+ARTISTS = 40
+TRACKS_PER_ARTIST = 20
+LOVED_TRACKS = 2500
+TRACK_DURATION = 200.0
+TICK = 0.02
+END_FILE_EOF, END_FILE_ABORTED, END_FILE_ERROR = 0, 2, 4
+
+profile = PROFILES['typical']
+rng = random.Random(0)
+request_counts = Counter()
+counts_lock = threading.Lock()
+playback_events = []
+playback_cond = threading.Condition()
+main = None
+
+
+def count(name):
+    with counts_lock:
+        request_counts[name] += 1
+
+
+def delay(kind):
+    mean, jitter = profile[kind]
+    time.sleep(max(0.0, rng.gauss(mean, jitter)))
+
+
+def stable_hash(text):
+    return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+
+
+def artist_name(i):
+    return f"Artist {i % ARTISTS}"
+
+
+def track_name(artist_index, i):
+    return f"Song {artist_index % ARTISTS}-{i % TRACKS_PER_ARTIST}"
+
+
+def artist_index(name):
+    try:
+        return int(str(name).rsplit(' ', 1)[-1])
+    except ValueError:
+        return stable_hash(str(name)) % ARTISTS
+
+
+def track_item(artist_i, i, **extra):
+    return dict({'name': track_name(artist_i, i), 'artist': {'name': artist_name(artist_i)}}, **extra)
+
+
+def lastfm_response(params):
+    method = params.get('method', '').lower()
+    limit = int(params.get('limit', 50))
+    artist = params.get('artist', artist_name(0))
+    a = artist_index(artist)
+    if method == 'track.getsimilar':
+        h = stable_hash(f"{artist} - {params.get('track', '')}")
+        return {'similartracks': {'track': [
+            track_item(h + i * 7 + 1, h + i, match=round(1 - i / 20, 3)) for i in range(limit)]}}
+    if method == 'track.getinfo':
+        return {'track': {'name': params.get('track'), 'album': {'title': f"Album {a}"}}}
+    if method == 'artist.getsimilar':
+        return {'similarartists': {'artist': [
+            {'name': artist_name(a + i + 1), 'match': round(1 - i / 15, 3)} for i in range(limit)]}}
+    if method == 'artist.gettoptracks':
+        return {'toptracks': {'track': [track_item(a, i) for i in range(limit)]}}
+    if method == 'artist.gettopalbums':
+        return {'topalbums': {'album': [{'name': f"Album {a}", 'artist': {'name': artist}}]}}
+    if method == 'user.getrecenttracks':
+        now = int(time.time())
+        since = int(params.get('from', 0))
+        tracks = [track_item(i * 3, 0, loved='0', date={'uts': str(now - i * 200)}) for i in range(min(limit, 5))]
+        return {'recenttracks': {'track': [t for t in tracks if int(t['date']['uts']) >= since]}}
+    if method == 'user.getlovedtracks':
+        page = int(params.get('page', 1))
+        total_pages = -(-LOVED_TRACKS // limit)
+        start = (page - 1) * limit
+        tracks = [track_item(i, i // ARTISTS, date={'uts': str(1700000000 - i * 60)})
+                  for i in range(start, min(start + limit, LOVED_TRACKS))]
+        return {'lovedtracks': {'@attr': {'page': str(page), 'totalPages': str(total_pages),
+                                          'total': str(LOVED_TRACKS)}, 'track': tracks}}
+    if method == 'track.search':
+        return {'results': {'trackmatches': {'track': [
+            {'name': track_name(i, 0), 'artist': artist_name(i)} for i in range(limit)]}}}
+    if method == 'album.search':
+        return {'results': {'albummatches': {'album': [{'name': params.get('album'), 'artist': artist}]}}}
+    if method == 'album.getinfo':
+        album = params.get('album', '')
+        return {'album': {'name': album, 'artist': artist, 'tracks': {'track': [
+            track_item(a, i) for i in range(artist_index(album))]}}}
+    if method == 'artist.search':
+        return {'results': {'artistmatches': {'artist': [{'name': artist}]}}}
+    if method == 'tag.search':
+        return {'results': {'tagmatches': {'tag': [{'name': params.get('tag')}]}}}
+    if method in ('tag.gettoptracks', 'user.gettoptracks'):
+        key = 'tracks' if method == 'tag.gettoptracks' else 'toptracks'
+        return {key: {'track': [track_item(i, i) for i in range(limit)]}}
+    if method == 'tag.gettopartists':
+        return {'topartists': {'artist': [{'name': artist_name(i)} for i in range(limit)]}}
+    return {'error': 3, 'message': 'Invalid Method - No method with that name in this package'}
+
+
+def similar_tracks_html(artist, track):
+    h = stable_hash(f"{artist} - {track}")
+    items = ''.join(
+        f'<li><h3><a href="#">{track_name(h + i, i)}</a></h3><p><span><a href="#">{artist_name(h + i)}</a></span></p></li>'
+        for i in range(10))
+    return f'<html><body><h3>Similar Tracks</h3><ol>{items}</ol></body></html>'
+
+
+def similar_artists_html(artist):
+    a = artist_index(artist)
+    items = ''.join(f'<li><h3><a href="#">{artist_name(a + i + 1)}</a></h3></li>' for i in range(10))
+    return f'<html><body><h2>Similar Artists</h2><ol>{items}</ol></body></html>'
+
+
+def video_ids(query):
+    h = stable_hash(query)
+    return [f"{(h + i) % 10 ** 11:011d}" for i in range(8)]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        role = self.server.role
+        if role == 'dead':
+            count('mirror dead')
+            time.sleep(self.server.hang)
+            self.close_connection = True
+            return
+        if role == 'lastfm':
+            count(f"lastfm {params.get('method', '?').lower()}")
+            delay('lastfm')
+            if rng.random() < profile['failure']:
+                return self.send_body(503, '{"error": 16}', 'application/json')
+            return self.send_body(200, json.dumps(lastfm_response(params)), 'application/json')
+        if role == 'web':
+            count('web html')
+            delay('web')
+            parts = [unquote(part) for part in url.path.split('/') if part]
+            if len(parts) >= 3 and parts[2] == '+similar':
+                return self.send_body(200, similar_artists_html(parts[1]), 'text/html')
+            if len(parts) >= 4:
+                return self.send_body(200, similar_tracks_html(parts[1], parts[3]), 'text/html')
+            return self.send_body(404, 'not found', 'text/html')
+        delay('mirror')
+        if rng.random() < profile['failure']:
+            count('mirror failed')
+            return self.send_body(502, 'bad gateway', 'text/html')
+        query = params.get('q', '')
+        if url.path == '/api/v1/search':
+            count('mirror api')
+            items = [{'videoId': vid, 'title': query, 'author': 'uploader', 'lengthSeconds': 200}
+                     for vid in video_ids(query)]
+            return self.send_body(200, json.dumps(items), 'application/json')
+        count('mirror html')
+        links = ''.join(f'<a href="/watch?v={vid}">{vid}</a>' for vid in video_ids(query))
+        return self.send_body(200, f'<html><body>{links}</body></html>', 'text/html')
+
+
+def start_server(role, hang=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.role = role
+    server.hang = hang
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def record_playback(kind, **data):
+    with playback_cond:
+        playback_events.append(dict(data, kind=kind, time=time.perf_counter()))
+        playback_cond.notify_all()
+
+
+class StubMPV:
+    halted = False
+    track_seconds = 1.0
+
+    def __init__(self, **options):
+        self.options = options
+        self.observers = {}
+        self.event_handlers = []
+        self.key_bindings = {}
+        self.properties = {'idle-active': True, 'time-pos': None, 'duration': None, 'playlist-pos': -1}
+        self.playlist = []
+        self.position = 0
+        self.generation = 0
+        self.entry_ids = itertools.count(1)
+        self.alive = True
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def idle_active(self):
+        return self.properties['idle-active']
+
+    @property
+    def duration(self):
+        return self.properties['duration']
+
+    @property
+    def time_pos(self):
+        return self.properties['time-pos']
+
+    @property
+    def metadata(self):
+        return {} if self.properties['duration'] else None
+
+    @property
+    def eof_reached(self):
+        return False
+
+    def _set(self, name, value):
+        self.properties[name] = value
+        for handler in list(self.observers.get(name, [])):
+            handler(name, value)
+
+    def observe_property(self, name, handler):
+        self.observers.setdefault(name, []).append(handler)
+        handler(name, self.properties.get(name))
+
+    def unobserve_property(self, name, handler):
+        self.observers.get(name, []).remove(handler)
+
+    def property_observer(self, name):
+        def register(handler):
+            self.observe_property(name, handler)
+            return handler
+        return register
+
+    def event_callback(self, *event_types):
+        def register(callback):
+            def wrapper(event):
+                if event.event_id in event_types:
+                    callback(event)
+            wrapper.unregister_mpv_events = lambda: self.event_handlers.remove(wrapper)
+            self.event_handlers.append(wrapper)
+            return wrapper
+        return register
+
+    def _emit(self, event_id, **data):
+        event = types.SimpleNamespace(event_id=event_id, data=types.SimpleNamespace(**data))
+        for handler in list(self.event_handlers):
+            handler(event)
+
+    def on_key_press(self, key, *args, **kwargs):
+        def register(handler):
+            self.key_bindings[key] = handler
+            return handler
+        return register
+
+    def press(self, key):
+        record_playback('key', key=key)
+        self.key_bindings[key]()
+
+    def loadfile(self, url, mode='replace', index=None, **options):
+        if StubMPV.halted:
+            raise SystemExit
+        with self.cond:
+            entry = (next(self.entry_ids), url, options)
+            if mode == 'replace':
+                self.playlist = [entry]
+                self.position = 0
+                self.generation += 1
+            else:
+                self.playlist.append(entry)
+            self.cond.notify_all()
+
+    def play(self, url):
+        self.loadfile(url)
+
+    def playlist_next(self, mode='weak'):
+        with self.cond:
+            if self.position + 1 >= len(self.playlist) and mode != 'force':
+                return
+            self.position += 1
+            self.generation += 1
+            idle = self.position >= len(self.playlist)
+            self.cond.notify_all()
+        if idle:
+            self._set('playlist-pos', -1)
+            self._set('idle-active', True)
+
+    def stop(self, keep_playlist=False):
+        with self.cond:
+            self.playlist = []
+            self.position = 0
+            self.generation += 1
+            self.cond.notify_all()
+        self._set('playlist-pos', -1)
+        self._set('idle-active', True)
+
+    def command(self, *args):
+        pass
+
+    def set_property(self, *args):
+        pass
+
+    def terminate(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.alive and self.position >= len(self.playlist):
+                    self.cond.wait()
+                if not self.alive:
+                    return
+                generation = self.generation
+                index = self.position
+                entry_id, url, options = self.playlist[index]
+            self._play(generation, index, entry_id, url, options)
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                self.position = index + 1
+                idle = self.position >= len(self.playlist)
+            if idle:
+                self._set('playlist-pos', -1)
+                self._set('idle-active', True)
+
+    def _play(self, generation, index, entry_id, url, options):
+        record_playback('load', url=url)
+        self._emit('start-file', playlist_entry_id=entry_id)
+        self._set('idle-active', False)
+        self._set('playlist-pos', index)
+        if 'youtube.com/watch' in url and options.get('ytdl') != 'no':
+            count('mpv ytdl extract')
+            delay('extract')
+        if generation != self.generation:
+            self._emit('end-file', playlist_entry_id=entry_id, reason=END_FILE_ABORTED, error=0)
+            return
+        record_playback('start', url=url)
+        self._set('duration', TRACK_DURATION)
+        elapsed = 0.0
+        speed = TRACK_DURATION / StubMPV.track_seconds
+        while elapsed < TRACK_DURATION:
+            time.sleep(TICK)
+            if generation != self.generation or not self.alive:
+                break
+            elapsed = min(TRACK_DURATION, elapsed + TICK * speed)
+            self._set('time-pos', elapsed)
+        record_playback('end', url=url, eof=elapsed >= TRACK_DURATION)
+        self._set('time-pos', None)
+        self._set('duration', None)
+        reason = END_FILE_EOF if elapsed >= TRACK_DURATION else END_FILE_ABORTED
+        self._emit('end-file', playlist_entry_id=entry_id, reason=reason, error=0)
+
+
+def make_mpv_stub():
+    module = types.ModuleType('mpv')
+    module.MPV = StubMPV
+    module.MpvEventEndFile = types.SimpleNamespace(EOF=END_FILE_EOF, ABORTED=END_FILE_ABORTED,
+                                                   ERROR=END_FILE_ERROR)
+    return module
+
+
+def select_format(selector):
+    formats = [('249', 50), ('250', 70), ('251', 135)]
+    limit = re.search(r'abr<=(\d+)', selector)
+    if limit:
+        formats = [f for f in formats if f[1] <= int(limit.group(1))] or formats[:1]
+    return formats[-1]
+
+
+def make_yt_dlp_stub():
+    module = types.ModuleType('yt_dlp')
+    utils = types.ModuleType('yt_dlp.utils')
+
+    class DownloadError(Exception):
+        pass
+
+    class YoutubeDL:
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def extract_info(self, url, download=False):
+            count('yt-dlp extract')
+            delay('extract')
+            video_id = url.rsplit('=', 1)[-1]
+            if stable_hash(video_id) % 100 < profile['unavailable'] * 100:
+                raise DownloadError(f"ERROR: [youtube] {video_id}: Video unavailable")
+            format_id, abr = select_format(self.params.get('format', ''))
+            info = {'id': video_id, 'ext': 'webm', 'url': f"http://127.0.0.1:9/videoplayback?id={video_id}&expire={int(time.time()) + 6 * 3600}", 'acodec': 'opus',
+                    'format_id': format_id, 'abr': abr, 'http_headers': {}}
+            if download:
+                count('yt-dlp download')
+                delay('extract')
+                with open(self.prepare_filename(info), 'wb') as f:
+                    f.write(b'\0' * 4096)
+            return info
+
+        def prepare_filename(self, info):
+            return self.params['outtmpl'].replace('%(ext)s', info['ext'])
+
+    utils.DownloadError = DownloadError
+    module.utils = utils
+    module.YoutubeDL = YoutubeDL
+    return module, utils
+
+
+class FakeNetwork:
+    def update_now_playing(self, **kwargs):
+        count('pylast track.updateNowPlaying')
+
+    def scrobble(self, **kwargs):
+        count('pylast track.scrobble')
+
+    def scrobble_many(self, tracks):
+        count('pylast track.scrobble')
+
+
+def import_main(workdir):
+    global main
+    yt_dlp, yt_dlp_utils = make_yt_dlp_stub()
+    sys.modules['mpv'] = make_mpv_stub()
+    sys.modules['yt_dlp'] = yt_dlp
+    sys.modules['yt_dlp.utils'] = yt_dlp_utils
+    os.environ.update(username='benchmark', password='benchmark',
+                      LASTFM_API_KEY='benchmark', LASTFM_API_SECRET='benchmark')
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import main as main_module
+    main = main_module
+    main.args = main.build_parser().parse_args([])
+    main.load_credentials()
+    fake_network = FakeNetwork()
+    main.get_network = lambda: fake_network
+    main.users_track_info = lambda artist, track: count('pylast track.getInfo')
+
+
+def reset_main(workdir, name, mirrors):
+    with main.db_lock:
+        if main.db_conn is not None:
+            main.db_conn.close()
+            main.db_conn = None
+        main.DB_PATH = workdir / f"{name}.db"
+    with main.prefetch_cond:
+        main.prefetch_generation += 1
+        main.prefetch_queue.clear()
+        main.prefetch_cond.notify_all()
+    main.played_tracks.clear()
+    main.history_state.update(position=0)
+    main.reserved_tracks.clear()
+    main.aborted_artists.clear()
+    main.recent_tracks_index.clear()
+    main.loved_tracks_index.clear()
+    main.mirror_api_disabled.clear()
+    with main.rate_lock:
+        main.rate_tokens = main.LASTFM_RATE_BURST
+    main.new_track = False
+    main.tag_played = False
+    main.MIRRORS_PATH.write_text(json.dumps(mirrors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+def measure_calls(func, inputs):
+    before = Counter(request_counts)
+    latencies = []
+    for item in inputs:
+        start = time.perf_counter()
+        func(*item)
+        latencies.append(time.perf_counter() - start)
+    requests = Counter(request_counts)
+    requests.subtract(before)
+    return dict(summarize(latencies), requests={k: v for k, v in sorted(requests.items()) if v})
+
+
+def run_radio(transitions, skip_rate):
+    before = Counter(request_counts)
+    with playback_cond:
+        playback_events.clear()
+    seed = track_item(0, 0)
+    started = time.perf_counter()
+
+    threading.Thread(target=main.play_track, args=(seed,), daemon=True).start()
+    starts = 0
+    deadline = time.time() + 120 + transitions * (StubMPV.track_seconds + 60)
+    while starts <= transitions and time.time() < deadline:
+        with playback_cond:
+            playback_cond.wait_for(lambda: sum(e['kind'] == 'start' for e in playback_events) > starts, timeout=1)
+            starts = sum(e['kind'] == 'start' for e in playback_events)
+        if starts and starts <= transitions and rng.random() < skip_rate:
+            time.sleep(StubMPV.track_seconds * rng.uniform(0.1, 0.4))
+            player = main.player
+            if player is not None:
+                player.press('q')
+    StubMPV.halted = True
+    return playback_summary(started, before)
+
+
+def run_album(tracks):
+    before = Counter(request_counts)
+    with playback_cond:
+        playback_events.clear()
+    started = time.perf_counter()
+    album = main.search_album(f"Album {tracks}")
+    main.play_album(album)
+    return playback_summary(started, before)
+
+
+def playback_summary(started, before):
+    with playback_cond:
+        events = list(playback_events)
+    first_start = next((e['time'] for e in events if e['kind'] == 'start'), None)
+    transition_latencies = []
+    ended = None
+    for event in events:
+        if event['kind'] == 'key' or (event['kind'] == 'end' and event['eof']):
+            ended = ended or event['time']
+        elif event['kind'] == 'start' and ended is not None:
+            transition_latencies.append(event['time'] - ended)
+            ended = None
+    requests = Counter(request_counts)
+    requests.subtract(before)
+    return {
+        'time_to_first_audio': first_start - started if first_start else None,
+        'transitions': summarize(transition_latencies),
+        'requests': {k: v for k, v in sorted(requests.items()) if v},
+    }
+
+
+def run(args):
+    global profile
+    profile = PROFILES[args.latency]
+    rng.seed(args.seed)
+    StubMPV.track_seconds = args.track_seconds
+    workdir = Path(tempfile.mkdtemp(prefix='lastsimilarious-bench-'))
+    import_main(workdir)
+    main.args.quality = args.quality
+    main.HTTP_TIMEOUT = args.http_timeout
+    main.MIRRORS_PATH = workdir / 'mirrors.json'
+
+    _lastfm_server, lastfm_url = start_server('lastfm')
+    _web_server, web_url = start_server('web')
+    main.LASTFM_API_URL = f"{lastfm_url}/2.0/"
+    main.LASTFM_WEB_URL = web_url
+    mirrors = [start_server('dead', hang=args.http_timeout + 1)[1] for _ in range(args.dead_mirrors)]
+    mirrors += [start_server('mirror')[1] for _ in range(args.mirrors)]
+
+    seeds = [(track_item(i * 5, i),) for i in range(args.runs)]
+    artists = [(artist_name(i * 3),) for i in range(args.runs)]
+    results = {'profile': args.latency}
+
+    reset_main(workdir, 'loved', mirrors)
+    results['get_random_loved_track (cold)'] = measure_calls(main.get_random_loved_track, [()])
+    results['get_random_loved_track (warm)'] = measure_calls(main.get_random_loved_track, [()] * args.runs)
+
+    reset_main(workdir, 'similar', mirrors)
+    results['search_similar_track'] = measure_calls(main.search_similar_track, seeds)
+
+    reset_main(workdir, 'similar_artist', mirrors)
+    results['get_similar_artist_track'] = measure_calls(main.get_similar_artist_track, artists)
+
+    reset_main(workdir, 'track_url', mirrors)
+    results['get_track_url (cold)'] = measure_calls(main.get_track_url, seeds)
+    results['get_track_url (warm)'] = measure_calls(main.get_track_url, seeds)
+
+    reset_main(workdir, 'album', mirrors)
+    results['album'] = run_album(args.album_tracks)
+
+    reset_main(workdir, 'radio', mirrors)
+    results['radio'] = run_radio(args.transitions, args.skip_rate)
+    return results
+
+
+def format_seconds(value):
+    return '-' if value is None else f"{value * 1000:.0f} ms"
+
+
+def print_report(results, out):
+    print = functools.partial(builtins.print, file=out)
+    print(f"Profile: {results['profile']}")
+    for name, result in results.items():
+        if name in ('profile', 'album', 'radio'):
+            continue
+        print(f"\n{name}: {result['count']} calls, p50 {format_seconds(result['p50'])}, "
+              f"p95 {format_seconds(result['p95'])}, max {format_seconds(result['max'])}")
+        for request, total in result['requests'].items():
+            print(f"    {request}: {total} ({total / max(1, result['count']):.1f}/call)")
+    for name in ('album', 'radio'):
+        playback = results[name]
+        transitions = playback['transitions']
+        print(f"\n{name}: time to first audio {format_seconds(playback['time_to_first_audio'])}")
+        print(f"    {transitions['count']} transitions, p50 {format_seconds(transitions['p50'])}, "
+              f"p95 {format_seconds(transitions['p95'])}, max {format_seconds(transitions['max'])}")
+        for request, total in playback['requests'].items():
+            print(f"    {request}: {total}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Offline LastSimilarious benchmark')
+    parser.add_argument('--latency', choices=sorted(PROFILES), default='typical', help='Latency/failure profile')
+    parser.add_argument('--runs', type=int, default=5, help='Calls per lookup scenario')
+    parser.add_argument('--transitions', type=int, default=8, help='Radio transitions to measure')
+    parser.add_argument('--quality', choices=['low', 'balanced', 'best'], default='balanced', help="main.py's --quality")
+    parser.add_argument('--album-tracks', type=int, default=15, help='Tracks on the benchmark album')
+    parser.add_argument('--skip-rate', type=float, default=0.3, help="Share of radio tracks skipped with 'q'")
+    parser.add_argument('--track-seconds', type=float, default=3.0, help='Wall-clock length of a stub track')
+    parser.add_argument('--mirrors', type=int, default=3, help='Healthy Invidious stand-ins')
+    parser.add_argument('--dead-mirrors', type=int, default=1, help='Unresponsive mirrors at the head of the list')
+    parser.add_argument('--http-timeout', type=float, default=3.0, help='HTTP timeout used by main.py during the run')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help="Show main.py's own output")
+    args = parser.parse_args()
+    out = sys.stdout
+    if not args.verbose:
+        # main.py reports progress with print() from its worker threads, some of
+        # which are still running when the report is written.
+        sys.stdout = open(os.devnull, 'w')
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2), file=out)
+    else:
+        print_report(results, out)
+
+
+if __name__ == "__main__":
+    main_cli()
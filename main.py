@@ -1,63 +1,285 @@
 import os
+import re
 import sys
 import signal
 import argparse
-import requests
 import subprocess
 import configparser
 import time
 import hashlib
-import pylast
-import mpv
 import json
 import random
+import sqlite3
+import threading
+import queue
 
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from getpass import getpass
 from pathlib import Path
 
 env_path = './.env'
 
-if not os.path.exists(env_path):
-    with open(env_path, 'w') as f:
-        f.write('')
-
-load_dotenv()
-api_key = os.getenv("LASTFM_API_KEY")
-api_secret = os.getenv("LASTFM_API_SECRET")
-
-if not os.getenv('username'):
-    username = input("Enter your Last.fm Username: ")
-    with open(env_path, 'a') as f:
-        f.write(f'username={username}\n')
-
-if not os.getenv('password'):
-    password = getpass("Enter your password: ")
-    with open(env_path, 'a') as f:
-        f.write(f'password={password}\n')
-
-username = os.getenv("username")
-password = os.getenv("password")
-
-parser = argparse.ArgumentParser(description='Last.fm audio player')
-parser.add_argument('-n', '--track', metavar='TRACK', help='Search by track')
-parser.add_argument('-b', '--album', metavar='ALBUM', help='Search by album')
-parser.add_argument('-a', '--artist', metavar='ARTIST', help='Search by artist')
-parser.add_argument('-g', '--tag', metavar='TAG', help='Search by tag')
-parser.add_argument('-gr', '--tagrandom', metavar='TAG', help='Search by tag and play random song')
-parser.add_argument('-u', '--user', metavar='USER', help='Search by user')
-args = parser.parse_args()
+api_key = None
+api_secret = None
+username = None
+password = None
+credentials_lock = threading.Lock()
+
+args = None
+yt_dlp = None
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Last.fm audio player')
+    parser.add_argument('-n', '--track', metavar='TRACK', help='Search by track')
+    parser.add_argument('-b', '--album', metavar='ALBUM', help='Search by album')
+    parser.add_argument('-a', '--artist', metavar='ARTIST', help='Search by artist')
+    parser.add_argument('-g', '--tag', metavar='TAG', help='Search by tag')
+    parser.add_argument('-gr', '--tagrandom', metavar='TAG', help='Search by tag and play random song')
+    parser.add_argument('-u', '--user', metavar='USER', help='Search by user')
+    parser.add_argument('--prefetch', metavar='N', type=int, default=2, help='Number of upcoming radio tracks to select and resolve in the background')
+    parser.add_argument('--mirror-fanout', metavar='N', type=int, default=3, help='Number of mirrors to query at once (1 = one by one)')
+    parser.add_argument('--quality', choices=sorted(QUALITY_FORMATS), default='balanced', help='Audio stream quality: low (Opus up to ~64 kbps), balanced (up to ~128 kbps) or best')
+    parser.add_argument('--audio-cache', metavar='MB', type=int, default=0, help='Keep up to MB megabytes of repeatedly played tracks on disk (0 = off)')
+    parser.add_argument('--profile', metavar='PATH', nargs='?', const='./lastsimilarious-profile.jsonl', help='Write per-stage timings as JSON lines and print a summary on exit')
+    return parser
+
+def load_credentials():
+    global api_key, api_secret, username, password
+    with credentials_lock:
+        if username is not None:
+            return
+        from dotenv import load_dotenv
+        load_dotenv()
+        api_key = os.getenv("LASTFM_API_KEY")
+        api_secret = os.getenv("LASTFM_API_SECRET")
+        username = os.getenv("username")
+        password = os.getenv("password")
+
+        if not username:
+            username = input("Enter your Last.fm Username: ")
+            with open(env_path, 'a') as f:
+                f.write(f'username={username}\n')
+
+        if not password:
+            password = getpass("Enter your password: ")
+            with open(env_path, 'a') as f:
+                f.write(f'password={password}\n')
+
+def load_yt_dlp():
+    global yt_dlp
+    if yt_dlp is None:
+        try:
+            import yt_dlp as module
+        except ImportError:
+            module = False
+        yt_dlp = module
+    return yt_dlp or None
 
 played_tracks = OrderedDict()
+history_lock = threading.Lock()
+history_state = {'position': 0}
+reserved_tracks = set()
 aborted_artists = OrderedDict()
-recent_tracks = OrderedDict()
+recent_tracks_index = {}
+recent_tracks_lock = threading.Lock()
+loved_tracks_index = {}
+loved_tracks_cond = threading.Condition()
+profile_spans = []
+profile_lock = threading.Lock()
 
 new_track = False
 tag_played = False
 
 MIRRORS_PATH = Path(__file__).parent / "mirrors.json"
+DB_PATH = Path('./lastsimilarious.db')
+
+LASTFM_API_URL = "https://ws.audioscrobbler.com/2.0/"
+LASTFM_WEB_URL = "https://www.last.fm"
+
+HTTP_TIMEOUT = 10
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_POOL_SIZE = 16
+LASTFM_RATE_LIMIT = 5
+LASTFM_RATE_WINDOW = 5 * 60
+LASTFM_RATE_BURST = 60
+SIMILAR_ARTIST_BATCH = LASTFM_RATE_LIMIT - 1
+FANOUT_WORKERS = 32
+PLAYLIST_RESOLVE_WORKERS = 3
+
+DAY = 24 * 60 * 60
+API_CACHE_MAX_BYTES = 32 * 1024 * 1024
+API_CACHE_TTLS = {
+    'track.search': DAY,
+    'track.getinfo': 30 * DAY,
+    'track.getsimilar': 7 * DAY,
+    'album.search': 7 * DAY,
+    'album.getinfo': 30 * DAY,
+    'artist.search': 7 * DAY,
+    'artist.getsimilar': 7 * DAY,
+    'artist.gettoptracks': DAY,
+    'artist.gettopalbums': DAY,
+    'tag.search': 7 * DAY,
+    'tag.gettoptracks': DAY,
+    'tag.gettopartists': DAY,
+    'user.gettoptracks': DAY,
+}
+TRACK_URL_RECHECK_AGE = 7 * DAY
+NOW_PLAYING_REFRESH = 5 * 60
+RECENT_TRACKS_LIMIT = 30
+RECENT_TRACKS_REFRESH = 60
+LOVED_TRACKS_PAGE_SIZE = 1000
+LOVED_TRACKS_CHECK_SIZE = 50
+LOVED_TRACKS_REFRESH = 60 * 60
+LOVED_TRACKS_RESYNC = 7 * DAY
+PLAY_HISTORY_LIMIT = 5000
+PLAY_HISTORY_MAX_AGE = 30 * DAY
+GRAPH_SEEDS = 8
+GRAPH_SEED_DECAY = 0.6
+GRAPH_ARTIST_WEIGHT = 0.5
+GRAPH_MIN_CANDIDATES = 5
+GRAPH_EXPAND_TTL = 30 * DAY
+SCROBBLE_BATCH_SIZE = 50
+SCROBBLE_RETRY_MIN = 5
+SCROBBLE_RETRY_MAX = 15 * 60
+VALIDATION_TOP_K = 4
+STREAM_INFO_LIMIT = 256
+STREAM_INFO_TTL = 60 * 60
+STREAM_EXPIRY_MARGIN = 10 * 60
+AUDIO_CACHE_DIR = Path('./audio_cache')
+AUDIO_CACHE_MIN_PLAYS = 2
+AUDIO_CACHE_PLAY_CREDIT = DAY
+INVIDIOUS_API_FIELDS = 'videoId,title,author,lengthSeconds'
+
+class YtdlQuietLogger:
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        pass
+
+YTDL_OPTIONS = {
+    'logger': YtdlQuietLogger(),
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'skip_download': True,
+}
+QUALITY_FORMATS = {
+    'low': 'bestaudio[acodec=opus][abr<=64]/worstaudio[acodec=opus]/worstaudio/worst',
+    'balanced': 'bestaudio[abr<=128]/bestaudio/best',
+    'best': 'bestaudio/best',
+}
+
+DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS api_cache (
+        key TEXT PRIMARY KEY,
+        method TEXT NOT NULL,
+        body TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires REAL NOT NULL,
+        accessed REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS api_cache_accessed ON api_cache (accessed)",
+    """CREATE TABLE IF NOT EXISTS track_urls (
+        key TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        verified REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS play_history (
+        key TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        scrobbled INTEGER NOT NULL,
+        played_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS play_history_position ON play_history (position)",
+    """CREATE TABLE IF NOT EXISTS graph_edges (
+        source TEXT NOT NULL,
+        target TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        name TEXT,
+        weight REAL NOT NULL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (source, target)
+    )""",
+    """CREATE TABLE IF NOT EXISTS graph_nodes (
+        node TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        expanded REAL NOT NULL,
+        PRIMARY KEY (node, kind)
+    )""",
+    """CREATE TABLE IF NOT EXISTS loved_tracks (
+        user TEXT NOT NULL,
+        key TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        name TEXT NOT NULL,
+        loved_at INTEGER NOT NULL,
+        PRIMARY KEY (user, key)
+    )""",
+    """CREATE TABLE IF NOT EXISTS loved_tracks_sync (
+        user TEXT PRIMARY KEY,
+        total INTEGER NOT NULL,
+        synced REAL NOT NULL,
+        refreshed REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS audio_cache (
+        key TEXT PRIMARY KEY,
+        path TEXT,
+        size INTEGER NOT NULL DEFAULT 0,
+        plays INTEGER NOT NULL,
+        accessed REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS scrobbles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        artist TEXT NOT NULL,
+        track TEXT NOT NULL,
+        album TEXT,
+        timestamp INTEGER NOT NULL
+    )""",
+]
+
+db_conn = None
+db_lock = threading.RLock()
+
+mirrors_lock = threading.Lock()
+mirror_api_disabled = set()
+
+http_session = None
+http_session_lock = threading.Lock()
+rate_lock = threading.Lock()
+rate_tokens = LASTFM_RATE_BURST
+rate_updated = time.monotonic()
+
+network = None
+network_lock = threading.Lock()
+
+scrobble_thread = None
+scrobble_lock = threading.Lock()
+scrobble_wakeup = threading.Event()
+
+player = None
+player_lock = threading.Lock()
+key_handlers = {}
+
+prefetch_queue = deque()
+prefetch_cond = threading.Condition()
+prefetch_generation = 0
+
+ytdl_local = threading.local()
+stream_infos = OrderedDict()
+stream_infos_lock = threading.Lock()
+audio_cache_pool = None
+audio_cache_lock = threading.Lock()
+audio_cache_pending = set()
+fanout_pool = None
+fanout_lock = threading.Lock()
 
 def load_mirrors():
     try:
@@ -71,7 +293,7 @@ def load_mirrors():
 
 def save_mirrors(mirrors):
     try:
-        with MIRRORS_PATH.open("w", encoding="utf-8") as f:
+        with mirrors_lock, MIRRORS_PATH.open("w", encoding="utf-8") as f:
             json.dump(mirrors, f, ensure_ascii=False, indent=2)
     except Exception as e:
         print(f"[debug] save_mirrors error: {e}")
@@ -85,16 +307,240 @@ def promote_mirror(mirrors, url):
     save_mirrors(mirrors)
     return mirrors
 
+def get_db():
+    global db_conn
+    with db_lock:
+        if db_conn is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in DB_SCHEMA:
+                conn.execute(statement)
+            db_conn = conn
+        return db_conn
+
+def db_execute(query, params=()):
+    with db_lock:
+        return get_db().execute(query, params).fetchall()
+
+def api_cache_key(method, params):
+    key_params = {k: v for k, v in params.items() if k not in ('api_key', 'format', 'method')}
+    return json.dumps([method.lower(), sorted(key_params.items())], ensure_ascii=False, default=str)
+
+def api_cache_get(key):
+    try:
+        rows = db_execute("SELECT body, expires FROM api_cache WHERE key = ?", (key,))
+        if not rows:
+            return None
+        body, expires = rows[0]
+        now = time.time()
+        if expires < now:
+            db_execute("DELETE FROM api_cache WHERE key = ?", (key,))
+            return None
+        db_execute("UPDATE api_cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(body)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"[debug] api_cache_get error: {e}")
+        return None
+
+def api_cache_put(key, method, response, ttl):
+    try:
+        body = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with db_lock:
+            db_execute(
+                "INSERT OR REPLACE INTO api_cache (key, method, body, size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, method.lower(), body, len(body), now + ttl, now))
+            evict_api_cache(now)
+    except sqlite3.Error as e:
+        print(f"[debug] api_cache_put error: {e}")
+
+def evict_api_cache(now):
+    db_execute("DELETE FROM api_cache WHERE expires < ?", (now,))
+    total = db_execute("SELECT COALESCE(SUM(size), 0) FROM api_cache")[0][0]
+    if total <= API_CACHE_MAX_BYTES:
+        return
+    excess = total - API_CACHE_MAX_BYTES
+    evicted = []
+    for key, size in db_execute("SELECT key, size FROM api_cache ORDER BY accessed"):
+        if excess <= 0:
+            break
+        evicted.append((key,))
+        excess -= size
+    with db_lock:
+        get_db().executemany("DELETE FROM api_cache WHERE key = ?", evicted)
+
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = 'LastSimilarious'
+            http_session = session
+        return http_session
+
+def acquire_rate_token():
+    # Last.fm allows LASTFM_RATE_LIMIT requests per second averaged over
+    # LASTFM_RATE_WINDOW, so a burst is fine as long as the refill rate leaves
+    # room for it within the window.
+    global rate_tokens, rate_updated
+    refill = (LASTFM_RATE_LIMIT * LASTFM_RATE_WINDOW - LASTFM_RATE_BURST) / LASTFM_RATE_WINDOW
+    with rate_lock:
+        now = time.monotonic()
+        rate_tokens = min(LASTFM_RATE_BURST, rate_tokens + (now - rate_updated) * refill)
+        rate_updated = now
+        if rate_tokens < 1:
+            time.sleep((1 - rate_tokens) / refill)
+            rate_tokens = 1
+            rate_updated = time.monotonic()
+        rate_tokens -= 1
+
+def http_request(method, url, retries=HTTP_RETRIES, rate_limited=False, **kwargs):
+    import requests
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    for attempt in range(retries + 1):
+        if rate_limited:
+            acquire_rate_token()
+        try:
+            response = get_http_session().request(method, url, **kwargs)
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt == retries:
+                return response
+            print(f"[debug] HTTP {response.status_code} from {url}, retrying...")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries:
+                raise
+            print(f"[debug] {e.__class__.__name__} on {url}, retrying...")
+        time.sleep(HTTP_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
+def submit(func, *args):
+    # Submitted calls must not wait on other submitted calls: the pool is
+    # bounded, so workers blocked on queued work could starve it.
+    global fanout_pool
+    with fanout_lock:
+        if fanout_pool is None:
+            fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+    return fanout_pool.submit(func, *args)
+
+def gather_concurrently(calls):
+    # The first call runs on the caller's thread, so it is the one allowed to
+    # fan out further (race mirrors, validate candidates, fetch pages).
+    if not calls:
+        return []
+    (func, *args), *rest = calls
+    futures = [submit(f, *a) for f, *a in rest]
+    results = []
+    try:
+        results.append(func(*args))
+    except Exception as e:
+        results.append(e)
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+def run_concurrently(*calls):
+    results = gather_concurrently(calls)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def lastfm_get(method, params):
+    params = dict(params, method=method, api_key=api_key, format='json')
+    ttl = API_CACHE_TTLS.get(method.lower(), 0)
+    if ttl:
+        key = api_cache_key(method, params)
+        cached = api_cache_get(key)
+        if cached is not None:
+            return cached
+    response = http_get(LASTFM_API_URL, params=params, rate_limited=True).json()
+    if ttl and 'error' not in response:
+        api_cache_put(key, method, response, ttl)
+    return response
+
+@contextmanager
+def timed(stage, **details):
+    span = dict(details, ok=True)
+    if not args.profile:
+        yield span
+        return
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span['ok'] = False
+        raise
+    finally:
+        record_span(stage, started, time.perf_counter() - start, span)
+
+def record_span(stage, started, duration, details):
+    if not args.profile:
+        return
+    span = dict(details, stage=stage, start=round(started, 3), duration=round(duration, 4),
+                thread=threading.current_thread().name)
+    with profile_lock:
+        profile_spans.append((stage, duration))
+        try:
+            with open(args.profile, 'a') as f:
+                f.write(json.dumps(span) + '\n')
+        except OSError as e:
+            print(f"[debug] record_span error: {e}")
+
+def print_profile_summary():
+    with profile_lock:
+        spans = list(profile_spans)
+    if not spans:
+        return
+    durations = {}
+    for stage, duration in spans:
+        durations.setdefault(stage, []).append(duration)
+    print(f"\nStage timings ({args.profile}):")
+    for stage, values in durations.items():
+        values.sort()
+        p50 = values[int(0.5 * (len(values) - 1))]
+        p95 = values[int(round(0.95 * (len(values) - 1)))]
+        print(f"  {stage:<9} n={len(values):<4} p50={p50:.3f}s p95={p95:.3f}s max={values[-1]:.3f}s")
+
 def signal_handler(sig, frame):
     print("\nExiting...")
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-
 def get_network():
-    session_key = get_or_generate_session_key()
-    network = pylast.LastFMNetwork(api_key=api_key, api_secret=api_secret, session_key=session_key)
-    return network
+    global network
+    with network_lock:
+        if network is None:
+            import pylast
+            session_key = get_or_generate_session_key()
+            network = pylast.LastFMNetwork(api_key=api_key, api_secret=api_secret, session_key=session_key)
+        return network
+
+def invalidate_network(e):
+    global network
+    import pylast
+    try:
+        status = int(e.get_id())
+    except (TypeError, ValueError):
+        return
+    auth_statuses = (pylast.STATUS_AUTH_FAILED, pylast.STATUS_INVALID_SK,
+                     pylast.STATUS_TOKEN_UNAUTHORIZED, pylast.STATUS_TOKEN_EXPIRED)
+    if status not in auth_statuses:
+        return
+    with network_lock:
+        network = None
+        if status == pylast.STATUS_INVALID_SK:
+            delete_session_key()
 
 def search_track(query):
     global new_track
@@ -102,16 +548,13 @@ def search_track(query):
     current_page = 1
     current_index = 0
     while True:
-        url = "http://ws.audioscrobbler.com/2.0/?method=track.search"
         params = {
-                "api_key": api_key,
                 "track": query,
                 "limit": 5,
-                "page": current_page,
-                "format": "json"
+                "page": current_page
                 }
         print("\nSearching track... ")
-        response = requests.get(url, params=params).json()
+        response = lastfm_get('track.search', params)
         tracks = response['results']['trackmatches']['track']
         if not tracks:
             print("No more tracks found.")
@@ -149,104 +592,190 @@ def search_track(query):
     # return None
 
 def search_album(query):
-    url = "http://ws.audioscrobbler.com/2.0/?method=album.search"
     params = {
-            "api_key": api_key,
-            "album": query,
-            "format": "json"
+            "album": query
             }
     print("\nSearching album... ")
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('album.search', params)
     album = response['results']['albummatches']['album'][0]
     print("OK")
     return album
 
 def search_artist(query):
-    url = "http://ws.audioscrobbler.com/2.0/?method=artist.search"
     params = {
-            "api_key": api_key,
-            "artist": query,
-            "format": "json"
+            "artist": query
             }
     print("\nSearching artist... ")
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('artist.search', params)
     artist = response['results']['artistmatches']['artist'][0]
     print("OK")
     return artist
 
 def search_tag(query):
-    url = "http://ws.audioscrobbler.com/2.0/?method=tag.search"
     params = {
-            "api_key": api_key,
-            "tag": query,
-            "format": "json"
+            "tag": query
             }
     print("\nSearching tag... ")
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('tag.search', params)
     tag = response['results']['tagmatches']['tag'][0]
     print("OK")
     return tag
 
-def add_to_played_tracks(artist, track, scrobbled):
+def load_play_history():
+    cutoff = time.time() - PLAY_HISTORY_MAX_AGE
+    try:
+        with db_lock:
+            db_execute("DELETE FROM play_history WHERE played_at < ?", (cutoff,))
+            rows = db_execute("SELECT key, position, scrobbled FROM play_history ORDER BY position DESC LIMIT ?",
+                              (PLAY_HISTORY_LIMIT,))
+            if rows:
+                db_execute("DELETE FROM play_history WHERE position < ?", (rows[-1][1],))
+    except sqlite3.Error as e:
+        print(f"[debug] load_play_history error: {e}")
+        return
+    with history_lock:
+        for key, position, scrobbled in reversed(rows):
+            played_tracks.pop(key, None)
+            played_tracks[key] = scrobbled
+        if rows:
+            history_state['position'] = max(history_state['position'], rows[0][1])
+
+def history_key(artist, track):
     key = f"{artist} - {track}"
-    if artist and track:
-        key = key.lower()
-    if len(played_tracks) < 1:
-        played_tracks[key] = 1
+    return key.lower() if artist and track else key
+
+def reserve_track(artist, track):
+    key = history_key(artist, track)
+    with history_lock:
+        if key not in played_tracks:
+            played_tracks[key] = 0
+            reserved_tracks.add(key)
+    return key
+
+def release_track(artist, track):
+    key = history_key(artist, track)
+    with history_lock:
+        if key in reserved_tracks:
+            reserved_tracks.discard(key)
+            played_tracks.pop(key, None)
+
+def add_to_played_tracks(artist, track, scrobbled):
+    key = history_key(artist, track)
+    evicted = []
+    with history_lock:
+        reserved_tracks.discard(key)
+        played_tracks.pop(key, None)
+        played_tracks[key] = int(bool(scrobbled))
+        history_state['position'] += 1
+        position = history_state['position']
+        while len(played_tracks) > PLAY_HISTORY_LIMIT:
+            evicted_key, _ = played_tracks.popitem(last=False)
+            reserved_tracks.discard(evicted_key)
+            evicted.append((evicted_key,))
+    if not (artist and track):
         return
-    if key in played_tracks:
-        played_tracks.pop(key)
-        played_tracks[key] = 1
-    else:
-        played_tracks[key] = 1
-    if not scrobbled:
-        played_tracks.move_to_end(key, last=False)
-
-def get_previous_track():
-    if len(played_tracks):
-        keys = list(played_tracks.keys())
-        previous_key = keys[-1]
-        previous_value = played_tracks[previous_key]
-        artist, track = previous_key.split(" - ", 1)
-
-        data = {
-                'name': track,
-                'artist': artist
-                }
-        json_data = json.dumps(data)
-        return json_data
-    else:
-        return None
+    try:
+        with db_lock:
+            db_execute("INSERT OR REPLACE INTO play_history (key, position, scrobbled, played_at) VALUES (?, ?, ?, ?)",
+                       (key, position, int(bool(scrobbled)), time.time()))
+            get_db().executemany("DELETE FROM play_history WHERE key = ?", evicted)
+    except sqlite3.Error as e:
+        print(f"[debug] add_to_played_tracks error: {e}")
 
 def scrobble_track(artist, track, album):
-    network = get_network()
     try:
-        network.scrobble(artist=artist, title=track, album=album, timestamp=int(time.time()))
-    except pylast.WSError as e:
-        print(f"Ошибка: {e}")
+        db_execute("INSERT INTO scrobbles (artist, track, album, timestamp) VALUES (?, ?, ?, ?)",
+                   (artist, track, album, int(time.time())))
+    except sqlite3.Error as e:
+        print(f"[debug] scrobble_track error: {e}")
         return None
+    start_scrobbler()
+    scrobble_wakeup.set()
     return "Success"
 
+def start_scrobbler():
+    global scrobble_thread
+    with scrobble_lock:
+        if scrobble_thread is None:
+            scrobble_thread = threading.Thread(target=scrobble_worker, daemon=True)
+            scrobble_thread.start()
+
+def scrobble_worker():
+    delay = SCROBBLE_RETRY_MIN
+    while True:
+        try:
+            flushed = flush_scrobbles()
+        except Exception as e:
+            print(f"[debug] scrobble_worker error: {e}")
+            flushed = False
+        if flushed:
+            delay = SCROBBLE_RETRY_MIN
+            scrobble_wakeup.wait()
+            scrobble_wakeup.clear()
+        else:
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, SCROBBLE_RETRY_MAX)
+
+def flush_scrobbles():
+    import pylast
+    permanent_statuses = (pylast.STATUS_INVALID_SERVICE, pylast.STATUS_INVALID_METHOD,
+                          pylast.STATUS_INVALID_FORMAT, pylast.STATUS_INVALID_PARAMS,
+                          pylast.STATUS_INVALID_RESOURCE)
+    while True:
+        try:
+            rows = db_execute("SELECT id, artist, track, album, timestamp FROM scrobbles ORDER BY id LIMIT ?",
+                              (SCROBBLE_BATCH_SIZE,))
+        except sqlite3.Error as e:
+            print(f"[debug] flush_scrobbles error: {e}")
+            return False
+        if not rows:
+            return True
+        batch = [{'artist': artist, 'title': track, 'album': album, 'timestamp': timestamp}
+                 for _id, artist, track, album, timestamp in rows]
+        try:
+            with timed('scrobble', tracks=len(batch)):
+                get_network().scrobble_many(batch)
+        except pylast.WSError as e:
+            print(f"Ошибка: {e}")
+            invalidate_network(e)
+            try:
+                status = int(e.get_id())
+            except (TypeError, ValueError):
+                status = None
+            if status not in permanent_statuses:
+                return False
+            print(f"[debug] Dropping {len(rows)} scrobbles rejected by Last.fm.")
+        except (pylast.NetworkError, pylast.MalformedResponseError) as e:
+            print(f"[debug] Scrobble flush failed: {e}")
+            return False
+        with db_lock:
+            get_db().executemany("DELETE FROM scrobbles WHERE id = ?", [(row[0],) for row in rows])
+
 def update_now_playing(artist, track, album):
+    import pylast
     network = get_network()
     try:
         network.update_now_playing(artist=artist, title=track, album=album) 
     except pylast.WSError as e:
         print(f"Ошибка: {e}")
+        invalidate_network(e)
         return None
     return "Success"
 
 def add_to_loved_tracks(artist, track):
+    import pylast
     network = get_network()
     try:
         track_object = network.get_track(artist=artist, title=track) 
         track_object.love()
     except pylast.WSError as e:
         print(f"Ошибка: {e}")
+        invalidate_network(e)
         return None
     return "Success"
 
 def users_track_info(artist, track):
+    import pylast
     network = get_network()
     track = pylast.Track(artist=artist, title=track, network=network, username=username)
 
@@ -264,160 +793,402 @@ def users_track_info(artist, track):
     return
 
 def get_track_album(artist, track):
-    url = "http://ws.audioscrobbler.com/2.0/?method=track.getInfo"
     params = {
-            "api_key": api_key,
             "artist": artist,
-            "track": track,
-            "format": "json"
+            "track": track
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('track.getInfo', params)
     if response['track'].get('album'):
         album = response['track']['album']['title']
     else:
         album = None
     return album
 
+def get_player():
+    global player
+    with player_lock:
+        if player is None:
+            import mpv
+            player = mpv.MPV(ytdl=True, ytdl_format=get_audio_format(), video=False, idle=True, gapless_audio=True, prefetch_playlist=True,
+                             terminal=True, input_default_bindings=True, input_terminal=True)
+            for key in ('q', 's', 'l', 'n'):
+                player.on_key_press(key)(make_key_binding(key))
+        return player
+
+def make_key_binding(key):
+    def binding():
+        handler = key_handlers.get(key)
+        if handler:
+            handler()
+    return binding
+
+def set_key_handlers(**handlers):
+    key_handlers.clear()
+    key_handlers.update(handlers)
+
+def close_player():
+    global player
+    with player_lock:
+        if player is not None:
+            player.terminate()
+            player = None
+
 def play_track(track):
     global new_track, tag_played
+    import mpv
+    import pylast
     print("\nSearching url... ")
-    track_url = get_track_url(track)
+    if new_track:
+        track_url = get_track_source(track)
+        album = track['album']
+    else:
+        track_url, album = run_concurrently((get_track_source, track),
+                                            (get_track_album, get_artist_name(track), track['name']))
     if track_url is None:
         print("Exiting...")
         sys.exit(1)
     print("OK")
+    reserve_track(get_artist_name(track), track['name'])
+    start_prefetch(track)
+    player = get_player()
+    playback_cond = threading.Condition()
+    playback = {'entry': None, 'done': False, 'failed': False, 'scrobble_due': False, 'played': 0.0,
+                'load_started': None}
+    track_finished = False
+    artist_aborted = False
+
+    def finish_track():
+        with playback_cond:
+            playback['done'] = True
+            playback_cond.notify_all()
+
+    def on_time_pos(_name, time_pos):
+        duration = player.duration
+        if time_pos is None:
+            return
+        with playback_cond:
+            playback['played'] = max(playback['played'], time_pos)
+            if playback['load_started'] is not None:
+                started, load_started = playback['load_started']
+                playback['load_started'] = None
+                record_span('mpv load', started, time.perf_counter() - load_started, {'ok': True})
+            if duration and not playback['scrobble_due'] and time_pos >= 30:
+                if time_pos >= duration * 0.5 or time_pos >= 180:
+                    playback['scrobble_due'] = True
+                    playback_cond.notify_all()
+
+    @player.event_callback('start-file')
+    def on_start_file(event):
+        with playback_cond:
+            playback['entry'] = event.data.playlist_entry_id
+
+    @player.event_callback('end-file')
+    def on_end_file(event):
+        # event.data is only valid inside the callback, so copy what we need.
+        entry, reason, error = event.data.playlist_entry_id, event.data.reason, event.data.error
+        with playback_cond:
+            if entry != playback['entry']:
+                return
+            playback['done'] = True
+            if reason == mpv.MpvEventEndFile.ERROR:
+                playback['failed'] = True
+                print(f"\nPlayback failed (mpv error {error}).")
+            playback_cond.notify_all()
+
+    def my_q_binding():
+        nonlocal track_finished
+        track_finished = True
+        print("\nTrack aborted. Next...")
+        finish_track()
+
+    def my_s_binding():
+        player.set_property('terminal=False')
+
+    def my_l_binding():
+        response = input("\nAdd track to loved tracks? (y/n): ")
+        if response.lower() == "y":
+            add_to_loved_tracks(artist_name, track['name'])
+            print("\nTrack added to loved tracks.")
+        else:
+            print("\nCanceled.")
+
+    def my_n_binding():
+        nonlocal track_finished, artist_aborted
+        key = artist_name
+        if key in played_tracks:
+            aborted_artists[key] += 1
+        else:
+            aborted_artists[key] = 1
+        track_finished = True
+        artist_aborted = True
+        print("\nTrack aborted. Next...")
+        finish_track()
+
+    def start_playback(url):
+        with playback_cond:
+            playback.update(entry=None, done=False, failed=False, scrobble_due=False, played=0.0,
+                            load_started=(time.time(), time.perf_counter()))
+        load_track(player, url)
+
+    set_key_handlers(q=my_q_binding, s=my_s_binding, l=my_l_binding, n=my_n_binding)
+    player.observe_property('time-pos', on_time_pos)
     reconnecting = False
-    while True:
-        try:
-            if not reconnecting:
-                if isinstance(track.get('artist'), dict):
-                    artist_name = track['artist'].get('name', '')
-                else:
-                    artist_name = track.get('artist', '')
-                print("Artist: ", artist_name)
-                print("Track: ", track['name'])
-                if not new_track:
-                    album = get_track_album(artist_name, track['name'])
-                else:
-                    album = track['album']
-                print("Album: ", album)
-                player = mpv.MPV(ytdl=True, video=False, terminal=True, input_default_bindings=True, input_terminal=True)
-
-                @player.on_key_press('q')
-                def my_q_binding():
-                    nonlocal track_finished
-                    track_finished = True
-                    print("\nTrack aborted. Next...")
-
-                @player.on_key_press('s')
-                def my_s_binding():
-                    player.set_property('terminal=False')
-
-                @player.on_key_press('l')
-                def my_l_binding():
-                    response = input("\nAdd track to loved tracks? (y/n): ")
-                    if response.lower() == "y":
-                        add_to_loved_tracks(artist_name, track['name'])
-                        print("\nTrack added to loved tracks.")
-                    else:
-                        print("\nCanceled.")
-
-                @player.on_key_press('n')
-                def my_n_binding():
-                    nonlocal track_finished, artist_aborted
-                    key = artist_name
-                    if key in played_tracks:
-                        aborted_artists[key] += 1
+    try:
+        while True:
+            try:
+                if not reconnecting:
+                    artist_name = get_artist_name(track)
+                    print("Artist: ", artist_name)
+                    print("Track: ", track['name'])
+                    print("Album: ", album)
+                    scrobbled = False
+                    track_finished = False
+                    artist_aborted = False
+                    restarted = False
+                    start_playback(track_url)
+                    note_audio_play(artist_name, track['name'], track_url)
+                    if not new_track:
+                        run_concurrently((update_now_playing, artist_name, track['name'], album),
+                                         (users_track_info, artist_name, track['name']))
                     else:
-                        aborted_artists[key] = 1
-                    track_finished = True
-                    artist_aborted = True
-                    print("\nTrack aborted. Next...")
-
-                player.play(track_url)
-                playing = True
-                scrobbled = False
-                track_finished = False
-                artist_aborted = False
-                if not new_track:
-                    users_track_info(artist_name, track['name'])
-
-                add_to_played_tracks(artist_name, track['name'], scrobbled)
-                previous_track = get_previous_track()
-
-                if not tag_played:
-                    similar_track = search_similar_track(previous_track)
-                else:
-                    tag = args.tagrandom
-                    similar_track = get_random_track_by_tag(tag)
-
-                track_url = get_track_url(similar_track)
-
-            reconnecting = False
-
-            while playing:
-                update_now_playing(artist_name, track['name'], album)
-                if track_finished:
-                    break
-                if player.duration and player.duration != 'None':
-                    if player.time_pos >= float(player.duration) * 0.5 or player.time_pos >= 180:
-                        if not scrobbled and player.time_pos >= 30:
-                            print("\nScrobbling... ")
-                            scrobble_track(artist_name, track['name'], album)
-                            scrobbled = True
-                            print("OK")
-                            add_to_played_tracks(artist_name, track['name'], scrobbled)
-                            similar_track = search_similar_track(track)
-                            track_url = get_track_url(similar_track)
-
-                    if player.duration:
-                        if player.time_pos >= float(player.duration) - 9:
-                            if not track_finished:
-                                track_finished = True
-                                time.sleep(9)
-                
-                if not player.metadata and player.eof_reached:
+                        update_now_playing(artist_name, track['name'], album)
+                    now_playing_sent = time.time()
+
+                    add_to_played_tracks(artist_name, track['name'], scrobbled)
+
+                reconnecting = False
+
+                while True:
+                    with playback_cond:
+                        playback_cond.wait_for(
+                            lambda: playback['done'] or (playback['scrobble_due'] and not scrobbled),
+                            timeout=NOW_PLAYING_REFRESH)
+                        done = playback['done']
+                        failed = playback['failed']
+                        scrobble_due = playback['scrobble_due']
+                        played = playback['played']
+                    if scrobble_due and not scrobbled:
+                        print("\nScrobbling... ")
+                        scrobble_track(artist_name, track['name'], album)
+                        scrobbled = True
+                        print("OK")
+                        add_to_played_tracks(artist_name, track['name'], scrobbled)
+                    if done:
+                        break
+                    if time.time() - now_playing_sent >= NOW_PLAYING_REFRESH:
+                        update_now_playing(artist_name, track['name'], album)
+                        now_playing_sent = time.time()
+
+                if not track_finished and (failed or not played):
+                    if not restarted:
+                        print("Restarting playback...")
+                        restarted = True
+                        forget_stream(track_url)
+                        start_playback(track_url)
+                        reconnecting = True
+                        continue
                     print("Not metadata")
-                    player.terminate()
-                    break
-
-                time.sleep(1)
+                    forget_track_url(normalize_track_key(artist_name, track['name']))
 
-            if track_finished:
+                player.stop()
                 if not artist_aborted:
-                    track = similar_track
+                    track, track_url, album = next_prefetched_track()
                 else:
                     print("\nArtist aborted. Next...")
-                    if isinstance(previous_track, str):
-                        previous_track = json.loads(previous_track)
-                    artist_name = previous_track['artist']
-                    track = get_similar_artist_track(artist_name)
-                    track_url = get_track_url(track)
+                    track, track_url, album = next_prefetched_track(wait=False)
+                    if track is None:
+                        with timed('similar', artist=artist_name):
+                            track = get_similar_artist_track(artist_name) or get_random_loved_track()
+                        track_url = get_track_source(track)
+                        album = get_track_album(get_artist_name(track), track['name'])
+                        start_prefetch(track)
                 new_track = False
-            else:
-                break
 
-            player.terminate()
+            except pylast.NetworkError as e:
+                print(f"Network error occured {e}")
+                if not reconnecting:
+                    reconnecting = True
+                    print("Reconnecting...")
+                    time.sleep(5)
+                else:
+                    print("Already reconnecting, skipping...")
+                    time.sleep(5)
+            except Exception as e:
+                if "403" in str(e):
+                    print("Restarting playback...")
+                    forget_stream(track_url)
+                    start_playback(track_url)
+                    reconnecting = True
+                else:
+                    print(f"Error occured: {e}")
+    finally:
+        player.unobserve_property('time-pos', on_time_pos)
+        on_start_file.unregister_mpv_events()
+        on_end_file.unregister_mpv_events()
 
-        except pylast.NetworkError as e:
-            print(f"Network error occured {e}")
-            if not reconnecting:
-                reconnecting = True
-                print("Reconnecting...")
-                time.sleep(5)
-            else:
-                print("Already reconnecting, skipping...")
-                time.sleep(5)
+def get_artist_name(track):
+    if isinstance(track.get('artist'), dict):
+        return track['artist'].get('name', '')
+    return track.get('artist', '')
+
+def select_next_track(track):
+    with timed('similar', track=track.get('name')):
+        if tag_played:
+            return get_random_track_by_tag(args.tagrandom)
+        next_track = search_similar_track(track)
+        if not next_track:
+            next_track = get_random_loved_track()
+        return next_track
+
+def prefetch_worker(generation, track):
+    while True:
+        with prefetch_cond:
+            while generation == prefetch_generation and len(prefetch_queue) >= max(1, args.prefetch):
+                prefetch_cond.wait()
+            if generation != prefetch_generation:
+                return
+        try:
+            next_track = select_next_track(track)
+            track = next_track
+            artist_name = get_artist_name(next_track)
+            reserve_track(artist_name, next_track['name'])
+            track_url, album = run_concurrently((get_track_source, next_track),
+                                                (get_track_album, artist_name, next_track['name']))
+            if track_url is None:
+                continue
         except Exception as e:
-            if "403" in str(e):
-                print("Restarting playback...")
-                player.play(track_url)
-            else:
-                print(f"Error occured: {e}")
+            print(f"[debug] prefetch error: {e}")
+            time.sleep(5)
+            continue
+        with prefetch_cond:
+            if generation != prefetch_generation:
+                release_track(artist_name, next_track['name'])
+                return
+            prefetch_queue.append((next_track, track_url, album))
+            prefetch_cond.notify_all()
+
+def start_prefetch(track):
+    global prefetch_generation
+    with prefetch_cond:
+        prefetch_generation += 1
+        for queued, _, _ in prefetch_queue:
+            release_track(get_artist_name(queued), queued['name'])
+        prefetch_queue.clear()
+        prefetch_cond.notify_all()
+        generation = prefetch_generation
+    threading.Thread(target=prefetch_worker, args=(generation, track), daemon=True).start()
+
+def next_prefetched_track(wait=True):
+    with prefetch_cond:
+        while True:
+            while prefetch_queue:
+                track, track_url, album = prefetch_queue.popleft()
+                prefetch_cond.notify_all()
+                if get_artist_name(track) in aborted_artists:
+                    release_track(get_artist_name(track), track['name'])
+                    continue
+                return track, track_url, album
+            if not wait:
+                return None, None, None
+            print("\nWaiting for next track... ")
+            prefetch_cond.wait()
+
+def get_ytdl():
+    ydl = getattr(ytdl_local, 'ydl', None)
+    if ydl is None:
+        ydl = load_yt_dlp().YoutubeDL(dict(YTDL_OPTIONS, format=get_audio_format()))
+        ytdl_local.ydl = ydl
+    return ydl
+
+def extract_video_info(url):
+    yt_dlp = load_yt_dlp()
+    try:
+        info = get_ytdl().extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError:
+        return None
+    if not info or not (info.get('url') or info.get('requested_formats')):
+        return None
+    remember_stream(url, info)
+    return info
+
+def remember_stream(url, info):
+    if not info.get('url'):
+        return
+    with stream_infos_lock:
+        stream_infos[url] = {
+            'url': info['url'],
+            'headers': info.get('http_headers') or {},
+            'expires': parse_stream_expiry(info['url']) or time.time() + STREAM_INFO_TTL,
+            'description': describe_stream(info),
+        }
+        stream_infos.move_to_end(url)
+        while len(stream_infos) > STREAM_INFO_LIMIT:
+            stream_infos.popitem(last=False)
+
+def parse_stream_expiry(stream_url):
+    match = re.search(r'[?&/]expire[=/](\d+)', stream_url)
+    return int(match.group(1)) if match else None
+
+def get_stream(url):
+    with stream_infos_lock:
+        stream = stream_infos.get(url)
+    if stream and stream['expires'] - STREAM_EXPIRY_MARGIN > time.time():
+        return stream
+    return None
+
+def forget_stream(url):
+    with stream_infos_lock:
+        stream_infos.pop(url, None)
+
+def prepare_stream(url):
+    if get_stream(url) is None and url.startswith(('http://', 'https://')) and load_yt_dlp() is not None:
+        extract_video_info(url)
+    return get_stream(url)
+
+def escape_mpv_option(value):
+    value = str(value)
+    return f"%{len(value.encode())}%{value}"
+
+def load_track(player, url, mode='replace'):
+    stream = get_stream(url)
+    if stream is None:
+        player.loadfile(url, mode)
+        return
+    print(f"[debug] Playing extracted stream: {stream['description']}")
+    options = {'ytdl': 'no'}
+    headers = dict(stream['headers'])
+    user_agent = headers.pop('User-Agent', None)
+    if user_agent:
+        options['user_agent'] = escape_mpv_option(user_agent)
+    fields = [f"{name}: {value}" for name, value in headers.items() if ',' not in f"{name}{value}"]
+    if fields:
+        options['http_header_fields'] = escape_mpv_option(','.join(fields))
+    player.loadfile(stream['url'], mode, **options)
+
+def get_audio_format():
+    return QUALITY_FORMATS[args.quality]
+
+def describe_stream(info):
+    abr = info.get('abr') or info.get('tbr')
+    bitrate = f"{abr:.0f} kbps" if abr else "unknown bitrate"
+    return f"{info.get('acodec') or 'unknown codec'} {bitrate} (format {info.get('format_id')})"
 
 def is_video_available(url):
+    with timed('validate', url=url) as span:
+        if load_yt_dlp() is None:
+            span['available'] = is_video_available_subprocess(url)
+        else:
+            info = extract_video_info(url)
+            span['available'] = info is not None
+            if info:
+                span['abr'] = info.get('abr') or info.get('tbr')
+                print(f"[debug] Stream for {url}: {describe_stream(info)}")
+        return span['available']
+
+def is_video_available_subprocess(url):
     try:
-        output = subprocess.check_output(['yt-dlp', '--ignore-errors', '--skip-download', url], stderr=subprocess.DEVNULL)
+        output = subprocess.check_output(['yt-dlp', '--ignore-errors', '--skip-download', '--format', get_audio_format(), url],
+                                         stderr=subprocess.DEVNULL)
         output = output.decode('utf-8')
         if 'Video unavailable' in output or 'No video or audio streams selected' in output:
             return False
@@ -425,13 +1196,275 @@ def is_video_available(url):
     except subprocess.CalledProcessError:
         return False
 
+def validate_candidates(candidates):
+    candidates = iter(candidates)
+    pending = deque()
+
+    def submit_next():
+        video_url = next(candidates, None)
+        if video_url:
+            pending.append((video_url, submit(is_video_available, video_url)))
+
+    for _ in range(VALIDATION_TOP_K):
+        submit_next()
+    try:
+        while pending:
+            video_url, future = pending.popleft()
+            print(f"[debug] Found candidate video: {video_url}")
+            if future.result():
+                return video_url
+            print(f"[debug] Candidate not available: {video_url}")
+            submit_next()
+    finally:
+        for _, future in pending:
+            future.cancel()
+    return None
+
+def normalize_track_key(artist, track):
+    return ' '.join(f"{artist} - {track}".lower().split())
+
+def get_cached_track_url(key):
+    try:
+        rows = db_execute("SELECT url, verified FROM track_urls WHERE key = ?", (key,))
+    except sqlite3.Error as e:
+        print(f"[debug] get_cached_track_url error: {e}")
+        return None
+    if not rows:
+        return None
+    url, verified = rows[0]
+    if time.time() - verified < TRACK_URL_RECHECK_AGE:
+        print(f"[debug] Cached url for '{key}': {url}")
+        return url
+    print(f"[debug] Re-checking cached url for '{key}': {url}")
+    if is_video_available(url):
+        save_track_url(key, url)
+        return url
+    forget_track_url(key)
+    return None
+
+def save_track_url(key, url):
+    try:
+        db_execute("INSERT OR REPLACE INTO track_urls (key, url, verified) VALUES (?, ?, ?)", (key, url, time.time()))
+    except sqlite3.Error as e:
+        print(f"[debug] save_track_url error: {e}")
+
+def forget_track_url(key):
+    try:
+        db_execute("DELETE FROM track_urls WHERE key = ?", (key,))
+    except sqlite3.Error as e:
+        print(f"[debug] forget_track_url error: {e}")
+
+def fetch_mirror_candidates(mirror_url, search_query):
+    if mirror_url not in mirror_api_disabled:
+        candidates = fetch_mirror_api_candidates(mirror_url, search_query)
+        if candidates is not None:
+            return candidates
+        print(f"[debug] API disabled on {mirror_url}, falling back to HTML search.")
+        mirror_api_disabled.add(mirror_url)
+    return fetch_mirror_html_candidates(mirror_url, search_query)
+
+def fetch_mirror_api_candidates(mirror_url, search_query):
+    api_url = f'{mirror_url.rstrip("/")}/api/v1/search?q={search_query}&type=video&fields={INVIDIOUS_API_FIELDS}'
+    resp = http_get(api_url, retries=0)
+    print(f"[debug] API {mirror_url} -> {resp.status_code}")
+    if resp.status_code in (403, 404, 410, 501):
+        return None
+    resp.raise_for_status()
+    try:
+        results = resp.json()
+    except ValueError:
+        return None
+    if not isinstance(results, list):
+        return None
+    candidates = []
+    for item in results:
+        if item.get('videoId') and item.get('lengthSeconds') != 0:
+            candidates.append(f'https://www.youtube.com/watch?v={item["videoId"]}')
+    return list(OrderedDict.fromkeys(candidates))
+
+def fetch_mirror_html_candidates(mirror_url, search_query):
+    search_url = f'{mirror_url.rstrip("/")}/search?q={search_query}'
+    resp = http_get(search_url, retries=0)
+    print(f"[debug] HTTP {mirror_url} -> {resp.status_code}")
+    resp.raise_for_status()
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(resp.text, 'html.parser')
+    candidates = []
+    video_link = soup.find('a', href=lambda href: href and href.startswith('/watch?v='))
+    while video_link:
+        candidates.append(f'https://www.youtube.com{video_link["href"]}')
+        video_link = video_link.find_next('a', href=lambda href: href and href.startswith('/watch?v='))
+    return list(OrderedDict.fromkeys(candidates))
+
+def fetch_mirror_result(idx, mirrors, search_query):
+    import requests
+    mirror_url = mirrors[idx]
+    print(f"[debug] Trying mirror {idx+1}/{len(mirrors)}: {mirror_url}")
+    with timed('mirror', mirror=mirror_url) as span:
+        try:
+            return mirror_url, fetch_mirror_candidates(mirror_url, search_query), None
+        except requests.exceptions.Timeout as e:
+            print(f"[debug] Timeout on {mirror_url}: {e}")
+            span['ok'] = False
+            return mirror_url, None, e
+        except requests.exceptions.RequestException as e:
+            print(f"[debug] Request error on {mirror_url}: {e}")
+            span['ok'] = False
+            return mirror_url, None, e
+        except Exception as e:
+            print(f"[debug] Unexpected error on {mirror_url}: {e}")
+            span['ok'] = False
+            return mirror_url, None, e
+
+def race_mirrors(mirrors, search_query, fanout):
+    mirrors = list(mirrors)
+    if fanout <= 1:
+        for idx in range(len(mirrors)):
+            yield fetch_mirror_result(idx, mirrors, search_query)
+        return
+    pending = set()
+    next_idx = 0
+
+    def submit_next():
+        nonlocal next_idx
+        if next_idx < len(mirrors):
+            pending.add(submit(fetch_mirror_result, next_idx, mirrors, search_query))
+            next_idx += 1
+
+    try:
+        for _ in range(fanout):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                yield future.result()
+                submit_next()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def get_track_source(track):
+    artist_name = get_artist_name(track)
+    source = get_cached_audio(artist_name, track['name'])
+    if source:
+        return source
+    source = get_track_url(track)
+    if source and prepare_stream(source) is None and load_yt_dlp() is not None:
+        print(f"[debug] Could not extract {source}, searching again.")
+        forget_track_url(normalize_track_key(artist_name, track['name']))
+        source = get_track_url(track)
+        if source:
+            prepare_stream(source)
+    return source
+
+def get_cached_audio(artist, track):
+    if not args.audio_cache:
+        return None
+    key = normalize_track_key(artist, track)
+    try:
+        rows = db_execute("SELECT path FROM audio_cache WHERE key = ? AND path IS NOT NULL", (key,))
+        if not rows:
+            return None
+        path = rows[0][0]
+        if not os.path.exists(path):
+            db_execute("UPDATE audio_cache SET path = NULL, size = 0 WHERE key = ?", (key,))
+            return None
+        db_execute("UPDATE audio_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error as e:
+        print(f"[debug] get_cached_audio error: {e}")
+        return None
+    print(f"[debug] Cached audio for '{key}': {path}")
+    return path
+
+def note_audio_play(artist, track, source):
+    if not args.audio_cache:
+        return
+    key = normalize_track_key(artist, track)
+    try:
+        db_execute("INSERT INTO audio_cache (key, plays, accessed) VALUES (?, 1, ?) "
+                   "ON CONFLICT(key) DO UPDATE SET plays = plays + 1, accessed = excluded.accessed",
+                   (key, time.time()))
+        plays, path = db_execute("SELECT plays, path FROM audio_cache WHERE key = ?", (key,))[0]
+    except sqlite3.Error as e:
+        print(f"[debug] note_audio_play error: {e}")
+        return
+    if path is None and plays >= AUDIO_CACHE_MIN_PLAYS and source.startswith(('http://', 'https://')):
+        start_audio_download(key, source)
+
+def start_audio_download(key, url):
+    global audio_cache_pool
+    with audio_cache_lock:
+        if key in audio_cache_pending:
+            return
+        audio_cache_pending.add(key)
+        if audio_cache_pool is None:
+            audio_cache_pool = ThreadPoolExecutor(max_workers=1)
+        audio_cache_pool.submit(download_audio, key, url)
+
+def download_audio(key, url):
+    try:
+        AUDIO_CACHE_DIR.mkdir(exist_ok=True)
+        template = str(AUDIO_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.%(ext)s")
+        yt_dlp = load_yt_dlp()
+        if yt_dlp is None:
+            output = subprocess.check_output(['yt-dlp', '--quiet', '--no-playlist', '--format', get_audio_format(),
+                                              '--output', template, '--no-simulate', '--print', 'after_move:filepath', url],
+                                             stderr=subprocess.DEVNULL)
+            path = output.decode('utf-8').strip().splitlines()[-1]
+        else:
+            options = dict(YTDL_OPTIONS, format=get_audio_format(), skip_download=False, outtmpl=template)
+            with yt_dlp.YoutubeDL(options) as ydl:
+                info = ydl.extract_info(url, download=True)
+                path = ydl.prepare_filename(info)
+            print(f"[debug] Downloaded '{key}': {describe_stream(info)}")
+        size = os.path.getsize(path)
+        db_execute("UPDATE audio_cache SET path = ?, size = ? WHERE key = ?", (path, size, key))
+        print(f"[debug] Cached audio for '{key}' ({size // 1024} KiB)")
+        evict_audio_cache()
+    except Exception as e:
+        print(f"[debug] download_audio error for '{key}': {e}")
+    finally:
+        with audio_cache_lock:
+            audio_cache_pending.discard(key)
+
+def evict_audio_cache():
+    budget = args.audio_cache * 1024 * 1024
+    with db_lock:
+        db_execute("DELETE FROM audio_cache WHERE path IS NULL AND accessed < ?", (time.time() - PLAY_HISTORY_MAX_AGE,))
+        total = db_execute("SELECT COALESCE(SUM(size), 0) FROM audio_cache WHERE path IS NOT NULL")[0][0]
+        if total <= budget:
+            return
+        rows = db_execute("SELECT key, path, size FROM audio_cache WHERE path IS NOT NULL "
+                          "ORDER BY accessed + plays * ?", (AUDIO_CACHE_PLAY_CREDIT,))
+        for key, path, size in rows:
+            if total <= budget:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"[debug] evict_audio_cache error: {e}")
+            db_execute("UPDATE audio_cache SET path = NULL, size = 0 WHERE key = ?", (key,))
+            total -= size
+
 def get_track_url(track):
+    with timed('search', track=track.get('name')) as span:
+        span['url'] = find_track_url(track)
+        span['ok'] = span['url'] is not None
+        return span['url']
+
+def find_track_url(track):
     track_name = track.get('name', '')
     if isinstance(track.get('artist'), dict):
         artist_name = track['artist'].get('name', '')
     else:
         artist_name = track.get('artist', '')
 
+    track_key = normalize_track_key(artist_name, track_name)
+    cached_url = get_cached_track_url(track_key)
+    if cached_url:
+        return cached_url
+
     search_query = f'{track_name} {artist_name}'
     search_query = '+'.join(search_query.split())
 
@@ -443,46 +1476,31 @@ def get_track_url(track):
     any_successful_request = False
     last_exception = None
 
-    for idx, mirror_url in enumerate(mirrors):
-        search_url = f'{mirror_url.rstrip("/")}/search?q={search_query}'
-        print(f"[debug] Trying mirror {idx+1}/{len(mirrors)}: {mirror_url}")
-        try:
-            resp = requests.get(search_url, timeout=10)
-            print(f"[debug] HTTP {mirror_url} -> {resp.status_code}")
-            resp.raise_for_status()
+    results = race_mirrors(mirrors, search_query, max(1, args.mirror_fanout))
+    try:
+        for mirror_url, candidates, error in results:
+            if error is not None:
+                last_exception = error
+                continue
             any_successful_request = True
-
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            video_link = soup.find('a', href=lambda href: href and href.startswith('/watch?v='))
-            found_any_link = False
-            while video_link:
-                found_any_link = True
-                video_url = f'https://www.youtube.com{video_link["href"]}'
-                print(f"[debug] Found candidate video: {video_url}")
-                if is_video_available(video_url):
+            if not candidates:
+                print(f"[debug] No /watch?v= links found on {mirror_url} search results.")
+                continue
+            try:
+                video_url = validate_candidates(candidates)
+                if video_url:
                     print(f"[debug] Video available via {mirror_url}, promoting mirror.")
                     promote_mirror(mirrors, mirror_url)
+                    save_track_url(track_key, video_url)
                     return video_url
-                else:
-                    print(f"[debug] Candidate not available: {video_url}")
-                video_link = video_link.find_next('a', href=lambda href: href and href.startswith('/watch?v='))
-            if not found_any_link:
-                print("[debug] No /watch?v= links found on {mirror_url} search results.")
-            else:
-                print(f"[debug] Page OK but no valid video found; promoting {mirror_url}.")
-                promote_mirror(mirrors, mirror_url)
-        except requests.exceptions.Timeout as e:
-            print(f"[debug] Timeout on {mirror_url}: {e}")
-            last_exception = e
-            continue
-        except requests.exceptions.RequestException as e:
-            print(f"[debug] Request error on {mirror_url}: {e}")
-            last_exception = e
-            continue
-        except Exception as e:
-            print(f"[debug] Unexpected error on {mirror_url}: {e}")
-            last_exception = e
-            continue
+            except Exception as e:
+                print(f"[debug] Unexpected error on {mirror_url}: {e}")
+                last_exception = e
+                continue
+            print(f"[debug] Page OK but no valid video found; promoting {mirror_url}.")
+            promote_mirror(mirrors, mirror_url)
+    finally:
+        results.close()
 
     if not any_successful_request:
         print("All mirrors are unavailables.")
@@ -492,59 +1510,152 @@ def get_track_url(track):
             print(f"[debug] Last exception: {last_exception}")
     return None
 
+def play_track_list(track_list):
+    player = get_player()
+    player.stop()
+    entries = []
+    current = {'index': None, 'scrobbled': False, 'load_started': None}
+    resolved = threading.Event()
+    events = queue.Queue()
+
+    def check_finished():
+        if resolved.is_set() and player.idle_active:
+            if not entries or current['index'] == len(entries) - 1:
+                events.put(None)
+
+    def resolve_track(track):
+        if 'album' in track:
+            return get_track_source(track), track['album']
+        return run_concurrently((get_track_source, track), (get_track_album, get_artist_name(track), track['name']))
+
+    def resolve_tracks():
+        try:
+            with ThreadPoolExecutor(max_workers=PLAYLIST_RESOLVE_WORKERS) as executor:
+                futures = [executor.submit(resolve_track, track) for track in track_list]
+                for track, future in zip(track_list, futures):
+                    try:
+                        track_url, album_name = future.result()
+                    except Exception as e:
+                        print(f"Error occured: {e}")
+                        continue
+                    if track_url is None:
+                        continue
+                    entries.append((track, get_artist_name(track), album_name, track_url))
+                    events.put(('resolved', None))
+        except Exception as e:
+            print(f"Error occured: {e}")
+        finally:
+            resolved.set()
+            check_finished()
+
+    def on_playlist_pos(_name, pos):
+        if pos is None or not 0 <= pos < len(entries):
+            return
+        current['index'] = pos
+        current['scrobbled'] = False
+        current['load_started'] = (time.time(), time.perf_counter())
+        events.put(('playing', pos))
+
+    def on_time_pos(_name, time_pos):
+        index = current['index']
+        duration = player.duration
+        if time_pos is not None and current['load_started'] is not None:
+            started, load_started = current['load_started']
+            current['load_started'] = None
+            record_span('mpv load', started, time.perf_counter() - load_started, {'ok': True})
+        if index is None or current['scrobbled'] or not time_pos or not duration:
+            return
+        if time_pos >= 30 and (time_pos >= duration * 0.5 or time_pos >= 180):
+            current['scrobbled'] = True
+            events.put(('scrobble', index))
+
+    def on_idle_active(_name, idle):
+        if idle:
+            check_finished()
+
+    def my_q_binding():
+        print("\nTrack aborted. Next...")
+        player.playlist_next('force')
+
+    def my_s_binding():
+        player.set_property('terminal=False')
+
+    def my_l_binding():
+        if current['index'] is None:
+            return
+        track, artist_name, _album_name, _track_url = entries[current['index']]
+        response = input("\nAdd track to loved tracks? (y/n): ")
+        if response.lower() == "y":
+            add_to_loved_tracks(artist_name, track['name'])
+            print("\nTrack added to loved tracks.")
+        else:
+            print("\nCanceled.")
+
+    set_key_handlers(q=my_q_binding, s=my_s_binding, l=my_l_binding)
+    observers = [('playlist-pos', on_playlist_pos), ('time-pos', on_time_pos), ('idle-active', on_idle_active)]
+    for name, handler in observers:
+        player.observe_property(name, handler)
+    threading.Thread(target=resolve_tracks, daemon=True).start()
+    loaded = 0
+    try:
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            kind, index = event
+            if kind == 'playing':
+                track, artist_name, album_name, track_url = entries[index]
+                print("Artist: ", artist_name)
+                print("Track: ", track['name'])
+                update_now_playing(artist_name, track['name'], album_name)
+                note_audio_play(artist_name, track['name'], track_url)
+            elif kind == 'scrobble':
+                track, artist_name, album_name, _track_url = entries[index]
+                scrobble_track(artist_name, track['name'], album_name)
+            # mpv only gets the playing entry and the one after it, so each
+            # stream is extracted again if it expired while the list played.
+            limit = min(len(entries), (current['index'] or 0) + 2)
+            while loaded < limit:
+                track_url = entries[loaded][3]
+                prepare_stream(track_url)
+                load_track(player, track_url, 'append-play')
+                loaded += 1
+    finally:
+        for name, handler in observers:
+            player.unobserve_property(name, handler)
+        player.stop()
+
 def play_album(album):
     track_list = get_album_tracks(album)
-    for track in track_list:
-        track_url = get_track_url(track)
-        if isinstance(track.get('artist'), dict):
-            artist_name = track['artist'].get('name', '')
-        else:
-            artist_name = track.get('artist', '')
-        print("Artist: ", artist_name)
-        print("Track: ", track['name'])
-        album_name = get_track_album(artist_name, track['name'])
-        subprocess.run(['mpv', '--no-video', '--no-sub', track_url])
-        scrobble_track(artist_name, track['name'], album_name)
+    play_track_list(track_list or [])
 
 def get_album_tracks(album):
-    album_search_url = "http://ws.audioscrobbler.com/2.0/?method=album.search"
     params = {
-            "api_key": api_key,
-            "artist": album['artist'],
-            "album": album['name'],
-            "format": "json"
+            "artist": get_artist_name(album),
+            "album": album['name']
             }
-    search_response = requests.get(album_search_url, params=params).json()
-    album_matches = search_response.get('results', {}).get('albummatches', {}).get('album', [])
-    if album_matches:
-        album_info = album_matches[0]
-        album_info_url = "http://ws.audioscrobbler.com/2.0/?method=album.getInfo"
+    info_response = lastfm_get('album.getInfo', params)
+    if 'album' not in info_response:
+        search_response = lastfm_get('album.search', params)
+        album_matches = search_response.get('results', {}).get('albummatches', {}).get('album', [])
+        if not album_matches:
+            return None
         album_params = {
-                "api_key": api_key,
-                "artist": album_info['artist'],
-                "album": album_info['name'],
-                "format": "json"
+                "artist": album_matches[0]['artist'],
+                "album": album_matches[0]['name']
                 }
-        info_response = requests.get(album_info_url, params=album_params).json()
-        track_list = info_response['album']['tracks']['track']
-
-        return track_list
-    else:
-        return None
+        info_response = lastfm_get('album.getInfo', album_params)
+        if 'album' not in info_response:
+            return None
+    album_name = info_response['album'].get('name', album['name'])
+    track_list = info_response['album'].get('tracks', {}).get('track', [])
+    if isinstance(track_list, dict):
+        track_list = [track_list]
+    return [dict(track, album=album_name) for track in track_list]
 
 def play_artist_tracks(artist):
     track_list = get_artist_tracks(artist, 50)
-    for track in track_list:
-        track_url = get_track_url(track)
-        if isinstance(track.get('artist'), dict):
-            artist_name = track['artist'].get('name', '')
-        else:
-            artist_name = track.get('artist', '')
-        print("Artist: ", artist_name)
-        print("Track: ", track['name'])
-        album_name = get_track_album(artist_name, track['name'])
-        subprocess.run(['mpv', '--no-video', '--no-sub', track_url])
-        scrobble_track(artist_name, track['name'], album_name)
+    play_track_list(track_list or [])
 
 def play_artist_albums(artist):
     album_list = get_artist_albums(artist)
@@ -552,112 +1663,95 @@ def play_artist_albums(artist):
             play_album(album)
 
 def get_artist_tracks(artist, limit):
-    url = "http://ws.audioscrobbler.com/2.0/?method=artist.gettoptracks"
     params = {
-            "api_key": api_key,
             "artist": artist['name'],
-            "limit": limit,
-            "format": "json"
+            "limit": limit
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('artist.gettoptracks', params)
     track_list = response['toptracks']['track']
     return track_list
 
 def get_artist_albums(artist):
-    url = "http://ws.audioscrobbler.com/2.0/?method=artist.gettopalbums"
     params = {
-            "api_key": api_key,
-            "artist": artist['name'],
-            "format": "json"
+            "artist": artist['name']
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('artist.gettopalbums', params)
     album_list = response['topalbums']['album']
     return album_list
 
 def play_tag(tag):
     track_list = get_popular_tracks_by_tag(tag)
-    for track in track_list:
-        track_url = get_track_url(track)
-        if isinstance(track.get('artist'), dict):
-            artist_name = track['artist'].get('name', '')
-        else:
-            artist_name = track.get('artist', '')
-        print("Artist: ", artist_name)
-        print("Track: ", track['name'])
-        album_name = get_track_album(artist_name, track['name'])
-        subprocess.run(['mpv', '--no-video', '--no-sub', track_url])
-        scrobble_track(artist_name, track['name'], album_name)
+    play_track_list(track_list or [])
 
 def play_user(user):
     track_list = get_popular_tracks_by_user(user)
-    for track in track_list:
-        track_url = get_track_url(track)
-        if isinstance(track.get('artist'), dict):
-            artist_name = track['artist'].get('name', '')
-        else:
-            artist_name = track.get('artist', '')
-        print("Artist: ", artist_name)
-        print("Track: ", track['name'])
-        album_name = get_track_album(artist_name, track['name'])
-        subprocess.run(['mpv', '--no-video', '--no-sub', track_url])
-        scrobble_track(artist_name, track['name'], album_name)
+    play_track_list(track_list or [])
 
 def get_popular_tracks_by_tag(tag):
-    url = "http://ws.audioscrobbler.com/2.0/?method=tag.gettoptracks"
     params = {
-            "api_key": api_key,
-            "tag": tag,
-            "format": "json"
+            "tag": tag
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('tag.gettoptracks', params)
     track_list = response['tracks']['track']
     return track_list
 
 def get_popular_artists_by_tag(tag):
-    url = "http://ws.audioscrobbler.com/2.0/?method=tag.gettopartists"
     params = {
-            "api_key": api_key,
-            "tag": tag,
-            "format": "json"
+            "tag": tag
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('tag.gettopartists', params)
     artist_list = response['topartists']['artist']
     return artist_list
 
 def get_popular_tracks_by_user(user):
-    url = "http://ws.audioscrobbler.com/2.0/?method=user.gettoptracks"
     params = {
-            "api_key": api_key,
-            "user": user,
-            "format": "json"
+            "user": user
             }
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('user.gettoptracks', params)
     track_list = response['toptracks']['track']
     return track_list
 
-def get_recent_tracks_by_user(user):
-    url = "http://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks"
+def get_recent_tracks_by_user(user, since=None):
     params = {
-            "api_key": api_key,
             "user": user,
-            "limit": 30,
-            "extended": 1,
-            "format": "json"
+            "limit": RECENT_TRACKS_LIMIT,
+            "extended": 1
             }
-    response = requests.get(url, params=params).json()
+    if since:
+        params["from"] = since
+    response = lastfm_get('user.getrecenttracks', params)
     track_list = response['recenttracks']['track']
+    if isinstance(track_list, dict):
+        track_list = [track_list]
     return track_list
 
 def get_recent_tracks_dict(user):
-    track_list = get_recent_tracks_by_user(user)
-    ordered_tracks = OrderedDict()
-    for track in track_list:
-        loved = track['loved']
-        if loved == '0':
-            artist_name = track['artist']['name'].lower()
-            track_name = track['name'].lower()
-            ordered_tracks[f"{artist_name} - {track_name}"] = None
-    return ordered_tracks
+    with recent_tracks_lock:
+        index = recent_tracks_index.setdefault(user, {'tracks': OrderedDict(), 'last_uts': 0, 'refreshed': 0.0})
+        if time.time() - index['refreshed'] >= RECENT_TRACKS_REFRESH:
+            index['refreshed'] = time.time()
+            try:
+                refresh_recent_tracks(user, index)
+            except Exception as e:
+                print(f"[debug] refresh_recent_tracks error: {e}")
+        return index['tracks']
+
+def refresh_recent_tracks(user, index):
+    since = index['last_uts'] + 1 if index['last_uts'] else None
+    ordered_tracks = index['tracks']
+    for track in reversed(get_recent_tracks_by_user(user, since)):
+        artist_name = track['artist']['name'].lower()
+        track_name = track['name'].lower()
+        key = f"{artist_name} - {track_name}"
+        if track['loved'] == '0':
+            ordered_tracks.pop(key, None)
+            ordered_tracks[key] = None
+        else:
+            ordered_tracks.pop(key, None)
+        if track.get('date'):
+            index['last_uts'] = max(index['last_uts'], int(track['date']['uts']))
+    while len(ordered_tracks) > RECENT_TRACKS_LIMIT:
+        ordered_tracks.popitem(last=False)
 
 def get_random_track_by_tag(tag):
     global tag_played   
@@ -670,24 +1764,31 @@ def get_random_track_by_tag(tag):
     return random_track
 
 def search_similar_track(track):
-    url = "http://ws.audioscrobbler.com/2.0/?method=track.getsimilar"
     if isinstance(track, str):
         track = json.loads(track)
     if isinstance(track.get('artist'), dict):
         artist_name = track['artist']['name']
     else:
         artist_name = track['artist']
+    source = track_node(artist_name, track['name'])
+    candidates = rank_graph_candidates(artist_name, track['name'])
+    if len(candidates) >= GRAPH_MIN_CANDIDATES or (candidates and is_graph_node_expanded(source, 'track')):
+        similar_track = candidates[0]
+        print(f"\nNext track is similar on graph: {similar_track['artist']['name']} - {similar_track['name']}")
+        return similar_track
+
     params = {
-        "api_key": api_key,
         "artist": artist_name,
         "track": track['name'],
-        "limit": 18,
-        "format": "json"
+        "limit": 18
         }
     print("\nSearching next track... ")
-    response = requests.get(url, params=params).json()
+    response = lastfm_get('track.getsimilar', params)
     if response.get('similartracks'):
         similar_tracks = response['similartracks']['track']
+        record_graph_edges(source, 'track', [
+            (track_node(t['artist']['name'], t['name']), t['artist']['name'], t['name'], float(t.get('match') or 0))
+            for t in similar_tracks])
     else:
         similar_artist_track = get_similar_artist_track(artist_name)
         return similar_artist_track 
@@ -706,39 +1807,234 @@ def search_similar_track(track):
         print(f"\nNext track is similar on track: {similar_track['artist']} - {similar_track['name']}")
         return similar_track
 
+    candidates = rank_graph_candidates(artist_name, track['name'])
+    if candidates:
+        similar_track = candidates[0]
+        print(f"\nNext track is similar on track: {similar_track['artist']['name']} - {similar_track['name']}")
+        return similar_track
+    return get_similar_artist_track(artist_name)
+
+def track_node(artist, track):
+    return f"track:{artist} - {track}".lower()
+
+def artist_node(artist):
+    return f"artist:{artist}".lower()
+
+def record_graph_edges(source, kind, edges):
+    now = time.time()
+    try:
+        with db_lock:
+            get_db().executemany(
+                "INSERT OR REPLACE INTO graph_edges (source, target, kind, artist, name, weight, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(source, target, kind, artist, name, weight, now) for target, artist, name, weight in edges])
+            db_execute("INSERT OR REPLACE INTO graph_nodes (node, kind, expanded) VALUES (?, ?, ?)", (source, kind, now))
+    except sqlite3.Error as e:
+        print(f"[debug] record_graph_edges error: {e}")
+
+def is_graph_node_expanded(node, kind):
+    try:
+        rows = db_execute("SELECT expanded FROM graph_nodes WHERE node = ? AND kind = ?", (node, kind))
+    except sqlite3.Error as e:
+        print(f"[debug] is_graph_node_expanded error: {e}")
+        return False
+    return bool(rows) and time.time() - rows[0][0] < GRAPH_EXPAND_TTL
+
+def get_graph_edges(sources, kind):
+    if not sources:
+        return []
+    placeholders = ', '.join('?' * len(sources))
+    return db_execute(
+        f"SELECT source, target, artist, name, weight FROM graph_edges WHERE kind = ? AND source IN ({placeholders})",
+        (kind, *sources))
+
+def get_graph_seeds(artist, track):
+    seeds = [f"{artist} - {track}".lower()]
+    with history_lock:
+        for key in reversed(played_tracks):
+            if len(seeds) >= GRAPH_SEEDS:
+                break
+            if key not in seeds and key != 'None - None' and ' - ' in key:
+                seeds.append(key)
+    return seeds
+
+def rank_graph_candidates(artist, track):
+    track_sources = {}
+    artist_sources = {}
+    for i, key in enumerate(get_graph_seeds(artist, track)):
+        seed_weight = GRAPH_SEED_DECAY ** i
+        track_sources[f"track:{key}"] = seed_weight
+        seed_artist = f"artist:{key.split(' - ', 1)[0]}"
+        artist_sources[seed_artist] = max(artist_sources.get(seed_artist, 0), seed_weight)
+
+    try:
+        scores = {}
+        tracks = {}
+        for source, target, target_artist, target_name, weight in get_graph_edges(list(track_sources), 'track'):
+            scores[target] = scores.get(target, 0) + track_sources[source] * weight
+            tracks[target] = (target_artist, target_name)
+        similar_artists = {}
+        for source, target, _artist, _name, weight in get_graph_edges(list(artist_sources), 'artist'):
+            similar_artists[target] = max(similar_artists.get(target, 0), artist_sources[source] * weight)
+        for source, target, target_artist, target_name, weight in get_graph_edges(list(similar_artists), 'track'):
+            scores[target] = scores.get(target, 0) + GRAPH_ARTIST_WEIGHT * similar_artists[source] * weight
+            tracks[target] = (target_artist, target_name)
+    except sqlite3.Error as e:
+        print(f"[debug] rank_graph_candidates error: {e}")
+        return []
+
     recent_tracks = get_recent_tracks_dict(username)
-    for similar_track in similar_tracks:
-        key = f"{similar_track['artist']['name']} - {similar_track['name']}"
-        key_lower = key.lower()
-        if key_lower not in played_tracks and key_lower not in recent_tracks:
-            print(f"\nNext track is similar on track: {similar_track['artist']['name']} - {similar_track['name']}")
-            return similar_track
+    aborted = {name.lower() for name in list(aborted_artists)}
+    candidates = []
+    for target, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        key = target[len('track:'):]
+        target_artist, target_name = tracks[target]
+        if key in played_tracks or key in recent_tracks or target_artist.lower() in aborted:
+            continue
+        candidates.append({'name': target_name, 'artist': {'name': target_artist}})
+    return candidates
 
 def get_random_loved_track():
     print("Searching random loved track... ")
-    url = "http://ws.audioscrobbler.com/2.0/?method=user.getlovedtracks"
-    user = username
-    params = {
-            "api_key": api_key,
-            "user": user,
-            "format": "json"
-            }
-    response = requests.get(url, params=params).json()
-    total_pages = int(response['lovedtracks']['@attr']['totalPages'])
-    if total_pages == 0:
+    track_list = get_loved_tracks(username)
+    if not track_list:
         raise ValueError("You have no tracks in your lovedtracks.")
-    random_page = random.randint(1, total_pages)
-    params["page"] = random_page
-    response = requests.get(url, params=params).json()
-    track_list = response['lovedtracks']['track']
     random_track = random.choice(track_list)
     print("OK")
-    return random_track
+    return {'name': random_track['name'], 'artist': dict(random_track['artist'])}
+
+def get_loved_tracks(user):
+    with loved_tracks_cond:
+        index = loved_tracks_index.get(user)
+        if index is None:
+            index = loved_tracks_index[user] = load_loved_tracks(user)
+        while index['refreshing'] and not index['tracks']:
+            loved_tracks_cond.wait()
+        if index['refreshing'] or time.time() - index['refreshed'] < LOVED_TRACKS_REFRESH:
+            return index['tracks']
+        index['refreshing'] = True
+        background = bool(index['tracks'])
+    if background:
+        threading.Thread(target=refresh_loved_tracks, args=(user, index), daemon=True).start()
+    else:
+        refresh_loved_tracks(user, index)
+    return index['tracks']
+
+def load_loved_tracks(user):
+    index = {'tracks': [], 'keys': set(), 'total': 0, 'synced': 0.0, 'refreshed': 0.0, 'refreshing': False}
+    try:
+        rows = db_execute("SELECT key, artist, name FROM loved_tracks WHERE user = ?", (user,))
+        sync = db_execute("SELECT total, synced, refreshed FROM loved_tracks_sync WHERE user = ?", (user,))
+    except sqlite3.Error as e:
+        print(f"[debug] load_loved_tracks error: {e}")
+        return index
+    for key, artist, name in rows:
+        index['keys'].add(key)
+        index['tracks'].append({'name': name, 'artist': {'name': artist}})
+    if sync and rows:
+        index['total'], index['synced'], index['refreshed'] = sync[0]
+    return index
+
+def refresh_loved_tracks(user, index):
+    rows = None
+    replace = False
+    try:
+        new_rows, total = [], None
+        if time.time() - index['synced'] < LOVED_TRACKS_RESYNC:
+            new_rows, total = fetch_new_loved_tracks(user, index['keys'])
+        if total is None or index['total'] + len(new_rows) != total:
+            rows, total = fetch_all_loved_tracks(user)
+            replace = True
+        else:
+            rows = new_rows
+        save_loved_tracks(user, rows, total, replace)
+    except Exception as e:
+        print(f"[debug] refresh_loved_tracks error: {e}")
+        rows = None
+    with loved_tracks_cond:
+        index['refreshing'] = False
+        if rows is not None:
+            index['total'] = total
+            index['refreshed'] = time.time()
+            if replace:
+                index['synced'] = index['refreshed']
+                index['tracks'] = []
+                index['keys'] = set()
+            for key, artist, name, _loved_at in rows:
+                if key not in index['keys']:
+                    index['keys'].add(key)
+                    index['tracks'].append({'name': name, 'artist': {'name': artist}})
+        loved_tracks_cond.notify_all()
+
+def parse_loved_tracks(response):
+    track_list = response['lovedtracks']['track']
+    if isinstance(track_list, dict):
+        track_list = [track_list]
+    rows = []
+    for track in track_list:
+        artist_name = get_artist_name(track)
+        loved_at = int(track.get('date', {}).get('uts', 0))
+        rows.append((normalize_track_key(artist_name, track['name']), artist_name, track['name'], loved_at))
+    return rows
+
+def fetch_new_loved_tracks(user, known_keys):
+    new_rows = []
+    page = 1
+    while True:
+        params = {
+                "user": user,
+                "limit": LOVED_TRACKS_CHECK_SIZE,
+                "page": page
+                }
+        response = lastfm_get('user.getlovedtracks', params)
+        attr = response['lovedtracks']['@attr']
+        for row in parse_loved_tracks(response):
+            if row[0] in known_keys:
+                return new_rows, int(attr['total'])
+            new_rows.append(row)
+        if page >= int(attr['totalPages']):
+            return new_rows, int(attr['total'])
+        page += 1
+
+def fetch_all_loved_tracks(user):
+    params = {
+            "user": user,
+            "limit": LOVED_TRACKS_PAGE_SIZE
+            }
+    print("Syncing loved tracks... ")
+    responses = [lastfm_get('user.getlovedtracks', dict(params, page=1))]
+    total_pages = int(responses[0]['lovedtracks']['@attr']['totalPages'])
+    if total_pages > 1:
+        responses += run_concurrently(*[(lastfm_get, 'user.getlovedtracks', dict(params, page=page))
+                                        for page in range(2, total_pages + 1)])
+    rows = OrderedDict()
+    for response in responses:
+        for row in parse_loved_tracks(response):
+            rows.setdefault(row[0], row)
+    return list(rows.values()), int(responses[0]['lovedtracks']['@attr']['total'])
+
+def save_loved_tracks(user, rows, total, replace):
+    now = time.time()
+    with db_lock:
+        conn = get_db()
+        conn.execute("BEGIN")
+        try:
+            if replace:
+                conn.execute("DELETE FROM loved_tracks WHERE user = ?", (user,))
+            conn.executemany("INSERT OR REPLACE INTO loved_tracks (user, key, artist, name, loved_at) VALUES (?, ?, ?, ?, ?)",
+                             [(user, *row) for row in rows])
+            conn.execute("INSERT INTO loved_tracks_sync (user, total, synced, refreshed) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(user) DO UPDATE SET total = excluded.total, refreshed = excluded.refreshed"
+                         + (", synced = excluded.synced" if replace else ""), (user, total, now, now))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
 
 def extract_similar_track_from_html(artist, track):
-    track_url = f"https://www.last.fm/music/{artist}/_/{track}"
-    response = requests.get(track_url)
+    track_url = f"{LASTFM_WEB_URL}/music/{artist}/_/{track}"
+    response = http_get(track_url)
     if response.status_code == 200:
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(response.content, 'html.parser')
         similar_track_section = soup.find('h3', string='Similar Tracks')
         if similar_track_section:
@@ -763,46 +2059,65 @@ def extract_similar_track_from_html(artist, track):
 def get_similar_artist_track(artist):
     if artist != 'None':
         artist_params = {
-                "api_key": api_key,
                 "artist": artist,
-                "limit": 12,
-                "format": "json"
+                "limit": 12
                 }
-        similar_artist_response = requests.get("http://ws.audioscrobbler.com/2.0/?method=artist.getsimilar", params=artist_params).json()
+        similar_artist_response = lastfm_get('artist.getsimilar', artist_params)
         similar_artists = similar_artist_response['similarartists']['artist']
+        if similar_artists:
+            record_graph_edges(artist_node(artist), 'artist', [
+                (artist_node(a['name']), a['name'], None, float(a.get('match') or 0)) for a in similar_artists])
 
         if not similar_artists:
             similar_artists = extract_similar_artist_from_html(artist)
 
         if similar_artists:
+            artist_names = []
             for artist in similar_artists:
                 if 'artist' in artist:
                     artist_name = artist['artist']
                 else:
                     artist_name = artist['name']
-                key = f"{artist_name}"
-                if key not in aborted_artists:
-                    top_tracks_params = {
-                        "api_key": api_key,
-                        "artist": artist_name,
-                        "limit": 6,
-                        "format": "json"
-                        }
-                    top_tracks_response = requests.get("http://ws.audioscrobbler.com/2.0/?method=artist.gettoptracks", params=top_tracks_params).json()
-                    top_tracks = top_tracks_response['toptracks']['track']
-
-                    recent_tracks = get_recent_tracks_dict(username)
+                if artist_name not in aborted_artists:
+                    artist_names.append(artist_name)
+            recent_tracks = None
+            next_track = None
+            for start in range(0, len(artist_names), SIMILAR_ARTIST_BATCH):
+                batch = artist_names[start:start + SIMILAR_ARTIST_BATCH]
+                calls = [(lastfm_get, 'artist.gettoptracks', {"artist": artist_name, "limit": 6}) for artist_name in batch]
+                if recent_tracks is None:
+                    recent_tracks, *top_tracks_responses = gather_concurrently([(get_recent_tracks_dict, username)] + calls)
+                    if isinstance(recent_tracks, BaseException):
+                        raise recent_tracks
+                else:
+                    top_tracks_responses = gather_concurrently(calls)
+
+                for artist_name, top_tracks_response in zip(batch, top_tracks_responses):
+                    if isinstance(top_tracks_response, BaseException):
+                        print(f"[debug] artist.gettoptracks error for {artist_name}: {top_tracks_response}")
+                        continue
+                    top_tracks = top_tracks_response.get('toptracks', {}).get('track', [])
+                    record_graph_edges(artist_node(artist_name), 'track', [
+                        (track_node(t['artist']['name'], t['name']), t['artist']['name'], t['name'], 1 - rank / len(top_tracks))
+                        for rank, t in enumerate(top_tracks)])
+                    if next_track is not None:
+                        continue
                     for top_track in top_tracks:
                         key = f"{top_track['artist']['name']} - {top_track['name']}"
                         key_lower = key.lower()
                         if key_lower not in played_tracks and key_lower not in recent_tracks:
-                            return top_track
+                            next_track = top_track
+                            break
+                if next_track is not None:
+                    break
+            return next_track
 
 def extract_similar_artist_from_html(artist):
     similar_artists = []
-    artist_url = f"https://www.last.fm/music/{artist}/+similar"
-    response = requests.get(artist_url)
+    artist_url = f"{LASTFM_WEB_URL}/music/{artist}/+similar"
+    response = http_get(artist_url)
     if response.status_code == 200:
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(response.content, 'html.parser')
         similar_artists_section = soup.find('h2', string='Similar Artists')
         if similar_artists_section.find_next('ol'):
@@ -818,19 +2133,19 @@ def extract_similar_artist_from_html(artist):
             return similar_artists
 
 def get_request_token(api_key, api_secret):
-    url = "http://ws.audioscrobbler.com/2.0/?method=auth.getToken"
+    url = f"{LASTFM_API_URL}?method=auth.getToken"
     api_sig = hashlib.md5((f"api_key{api_key}methodauth.getToken{api_secret}").encode()).hexdigest()
     params = {
             "api_key": api_key,
             "api_sig": api_sig,
             "format": "json"
             }
-    response = requests.post(url, data=params).json()
+    response = http_post(url, data=params, rate_limited=True).json()
     token = response["token"]
     return token
 
 def get_session_key(api_key, api_secret, token):
-    url = "http://ws.audioscrobbler.com/2.0/?method=auth.getSession"
+    url = f"{LASTFM_API_URL}?method=auth.getSession"
     api_sig = hashlib.md5((f"api_key{api_key}methodauth.getSessiontoken{token}{api_secret}").encode()).hexdigest()
     params = {
             "api_key": api_key,
@@ -838,7 +2153,7 @@ def get_session_key(api_key, api_secret, token):
             "token": token,
             "format": "json"
             }
-    response = requests.post(url, data=params).json()
+    response = http_post(url, data=params, rate_limited=True).json()
     session_key = response['session']['key']
     return session_key
 
@@ -851,7 +2166,7 @@ def get_or_generate_session_key():
         return session_key
     else:
         token = get_request_token(api_key, api_secret)
-        auth_url = f"http://www.last.fm/api/auth?api_key={api_key}&token={token}"
+        auth_url = f"{LASTFM_WEB_URL}/api/auth?api_key={api_key}&token={token}"
         print(f"Please grant permission at: {auth_url}")
         input("Press Enter after granting permission...")
         session_key = get_session_key(api_key, api_secret, token)
@@ -868,7 +2183,23 @@ def save_session_key(session_key):
     with open(config_path, 'w') as configfile:
         config.write(configfile)
 
+def delete_session_key():
+    config = configparser.ConfigParser()
+    config_path = './config.ini'
+    config.read(config_path)
+    if config.has_option('AUTH', 'SESSION_KEY'):
+        config.remove_option('AUTH', 'SESSION_KEY')
+        with open(config_path, 'w') as configfile:
+            config.write(configfile)
+
 def main():
+    global args
+    args = build_parser().parse_args()
+    signal.signal(signal.SIGINT, signal_handler)
+    import pylast
+    load_credentials()
+    load_play_history()
+    start_scrobbler()
     try:
         if args.track:
             track = search_track(args.track)
@@ -901,10 +2232,13 @@ def main():
 
         else:
             add_to_played_tracks(None, None, False)
-            track = get_random_loved_track()
+            track, _recent_tracks = run_concurrently((get_random_loved_track,), (get_recent_tracks_dict, username))
             play_track(track)
     except pylast.NetworkError as e:
         print("Network error:", str(e))
+    finally:
+        close_player()
+        print_profile_summary()
 
 if __name__ == "__main__":
     main()